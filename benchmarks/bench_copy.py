@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+Compare the in-process tree copy (dpu.utils.rsync) against spawning
+"rsync -arpc", both for a fresh copy and for re-syncing an unchanged tree.
+"""
+
+import os
+import time
+import argparse
+import subprocess
+
+from dpu.utils import rsync, tmpdir, mkdir, rmdir
+
+
+def make_tree(root, files, size, depth):
+    for x in range(files):
+        parts = ["d%d" % (x % (depth + 1 - y)) for y in range(depth)]
+        dpath = os.path.join(root, *parts)
+        if not os.path.isdir(dpath):
+            mkdir(dpath)
+        with open(os.path.join(dpath, "f%d" % (x)), "wb") as fd:
+            fd.write(os.urandom(size))
+
+
+def external_rsync(source, target):
+    subprocess.check_call(['rsync', '-arpc', source + "/", target + "/"])
+
+
+def timed(func, *args):
+    started = time.time()
+    func(*args)
+    return time.time() - started
+
+
+def bench(name, func, source, target, repeat):
+    fresh = []
+    resync = []
+    for _ in range(repeat):
+        if os.path.exists(target):
+            rmdir(target)
+        mkdir(target)
+        fresh.append(timed(func, source, target))
+        resync.append(timed(func, source, target))
+    print "%-10s fresh: %8.4fs  resync: %8.4fs" % (
+        name, min(fresh), min(resync))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=4096,
+                        help='Size of every file, in bytes')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tmpdir() as tmp:
+        source = os.path.join(tmp, "source")
+        target = os.path.join(tmp, "target")
+        mkdir(source)
+        make_tree(source, args.files, args.size, args.depth)
+        print "%d files of %d bytes, depth %d" % (
+            args.files, args.size, args.depth)
+        bench("in-process", rsync, source, target, args.repeat)
+        try:
+            bench("rsync", external_rsync, source, target, args.repeat)
+        except OSError:
+            print "rsync not available, skipping"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+Measure how much memory (and time) parsing and compiling a large, synthetic
+manifest takes.
+"""
+
+import os
+import gc
+import time
+import argparse
+import resource
+
+from dpu.manifest import parse_manifest
+from dpu.utils import tmpdir
+
+
+def write_manifest(path, entries, fanout):
+    with open(path, "w") as fd:
+        for x in range(entries):
+            dpath = "usr/lib/debug/.build-id/d%d/s%d" % (
+                x // (fanout * fanout), (x // fanout) % fanout)
+            kind = x % 10
+            if kind == 0:
+                fd.write("contains-symlink %s/l%d\n" % (dpath, x))
+                fd.write("link-target f%d\n" % (x - 1))
+            elif kind == 1:
+                fd.write("contains-entry -rwxr-xr-x %s/f%d\n" % (dpath, x))
+            else:
+                fd.write("contains-file %s/f%d\n" % (dpath, x))
+                fd.write("perm 0644\n")
+
+
+def maxrss():
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--fanout', type=int, default=64,
+                        help='Entries per directory')
+    args = parser.parse_args()
+
+    with tmpdir() as tmp:
+        mfile = os.path.join(tmp, "manifest")
+        write_manifest(mfile, args.entries, args.fanout)
+        gc.collect()
+        before = maxrss()
+        started = time.time()
+        man = parse_manifest(mfile)
+        parsed = time.time()
+        man._compile()
+        compiled = time.time()
+        after = maxrss()
+
+    entries = len(man._data)
+    print "%d entries (%d given, the rest implied directories)" % (
+        entries, args.entries)
+    print "parse:   %8.3fs" % (parsed - started)
+    print "compile: %8.3fs" % (compiled - parsed)
+    print "memory:  %8.1f MiB, %.0f bytes per entry" % (
+        (after - before) / 1024.0, (after - before) * 1024.0 / entries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+Time parsing manifests, writing and reading orig tarballs, and checking
+tarballs against manifests, for trees of a few sizes and every
+compression. Every operation runs in a child process of its own, so its
+peak RSS (from wait4) can be reported as well; that includes the ~10 MiB of
+the interpreter itself.
+
+With --output, the results are written to a JSON file, which a later run
+can be compared against with --compare.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import traceback
+
+from dpu.manifest import parse_manifest
+from dpu.tarball import make_orig_tarball, open_compressed_tarball
+from dpu.utils import tmpdir, mkdir
+
+try:
+    import apt_inst
+except ImportError:
+    apt_inst = None
+
+
+COMPRESSIONS = ["gzip", "bzip2", "xz", "lzma", "zstd"]
+
+
+def make_tree(root, members, size, fanout):
+    """
+    Write a tree of about `members' entries (files of `size' bytes, and the
+    directories holding `fanout' of them each) to `root', along with a
+    manifest describing all of it. Returns the path of the manifest.
+    """
+    files = max(1, members - members // (fanout + 1))
+    content = "dpu " * (size // 4)
+    manifest = os.path.join(os.path.dirname(root), "manifest-%d" % (members))
+    base = os.path.basename(root)
+    with open(manifest, "w") as man:
+        for x in range(files):
+            dname = "d%d" % (x // fanout)
+            dpath = os.path.join(root, dname)
+            if x % fanout == 0:
+                mkdir(dpath)
+                man.write("contains-dir %s/%s\n" % (base, dname))
+            with open(os.path.join(dpath, "f%d" % (x)), "w") as fd:
+                fd.write(content)
+            man.write("contains-file %s/%s/f%d\n" % (base, dname, x))
+            if x % 10 == 0:
+                man.write("perm 0644\n")
+        man.write("not-present %s/d0/missing\n" % (base))
+    return manifest
+
+
+def measure(func, *args):
+    """
+    Run `func(*args)' in a child process. `func' returns how many seconds
+    the interesting part of it took. Returns that and the peak RSS (in KiB)
+    of the child, or None if it failed.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        code = 0
+        try:
+            os.write(wfd, repr(func(*args)))
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        os._exit(code)
+    os.close(wfd)
+    with os.fdopen(rfd) as fd:
+        elapsed = fd.read()
+    _, status, usage = os.wait4(pid, 0)
+    if status != 0:
+        return None
+    return float(elapsed), usage.ru_maxrss
+
+
+def op_parse_manifest(manifest):
+    started = time.time()
+    parse_manifest(manifest)._compile()
+    return time.time() - started
+
+
+def op_make_orig_tarball(tmp, compression):
+    started = time.time()
+    make_orig_tarball(tmp, "bench", "1.0", compression=compression,
+                      outputdir=tmp, mtime=0)
+    return time.time() - started
+
+
+def op_open_compressed_tarball(tarball):
+    started = time.time()
+    with open_compressed_tarball(tarball) as tar:
+        for _ in tar:
+            pass
+    return time.time() - started
+
+
+def op_check_tarball(manifest, tarball):
+    man = parse_manifest(manifest)
+    man._compile()
+    started = time.time()
+    with open_compressed_tarball(tarball) as tar:
+        man.check_tarball(tar)
+    return time.time() - started
+
+
+def op_check_apt_tarball(manifest, tarball, compression):
+    man = parse_manifest(manifest)
+    man._compile()
+    started = time.time()
+    # python-apt assumes gzip unless told otherwise (and fails on the
+    # compressions its APT can't read).
+    man.check_apt_tarball(apt_inst.TarFile(tarball, comp=compression))
+    return time.time() - started
+
+
+def tarball_path(tmp, compression):
+    for name in os.listdir(tmp):
+        if name.startswith("bench_1.0.orig.tar"):
+            return os.path.join(tmp, name)
+    raise ValueError("No %s tarball was written" % (compression))
+
+
+class Results(object):
+    """
+    The results of a run, and those of an earlier one to compare with.
+    """
+
+    def __init__(self, previous=None):
+        self.results = []
+        self._previous = {}
+        if previous is not None:
+            for result in previous["results"]:
+                self._previous[self._key(result)] = result
+
+    def _key(self, result):
+        return (result["op"], result["members"], result["compression"])
+
+    def add(self, op, members, compression, measured):
+        label = "%-26s %8d %-6s" % (op, members, compression or "-")
+        if measured is None:
+            print "%s failed" % (label)
+            return
+        elapsed, maxrss = measured
+        result = {"op": op, "members": members, "compression": compression,
+                  "seconds": elapsed, "maxrss": maxrss}
+        self.results.append(result)
+        line = "%s %10.3fs %9.1f MiB" % (label, elapsed, maxrss / 1024.0)
+        previous = self._previous.get(self._key(result))
+        if previous is not None:
+            line += "  (%+.0f%% time, %+.0f%% memory)" % (
+                _change(previous["seconds"], elapsed),
+                _change(previous["maxrss"], maxrss))
+        print line
+        sys.stdout.flush()
+
+    def save(self, path):
+        with open(path, "w") as fd:
+            json.dump({"python": platform.python_version(),
+                       "host": platform.node(),
+                       "time": time.time(),
+                       "results": self.results}, fd, indent=1,
+                      sort_keys=True)
+
+
+def _change(before, after):
+    if not before:
+        return 0.0
+    return (after - before) * 100.0 / before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--members', type=int, nargs="*",
+                        default=[1000, 100000, 1000000],
+                        help='Tree sizes to benchmark')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Size of every file, in bytes')
+    parser.add_argument('--fanout', type=int, default=1000,
+                        help='Files per directory')
+    parser.add_argument('--compression', nargs="*", default=COMPRESSIONS)
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare with the results in this JSON file')
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as fd:
+            previous = json.load(fd)
+    results = Results(previous)
+    if apt_inst is None:
+        print "python-apt is not available, not timing check_apt_tarball"
+
+    os.umask(0022)
+    for members in args.members:
+        with tmpdir() as tmp:
+            root = os.path.join(tmp, "bench-1.0")
+            mkdir(root)
+            manifest = make_tree(root, members, args.size, args.fanout)
+            results.add("parse_manifest", members, None,
+                        measure(op_parse_manifest, manifest))
+            for compression in args.compression:
+                measured = measure(op_make_orig_tarball, tmp, compression)
+                results.add("make_orig_tarball", members, compression,
+                            measured)
+                if measured is None:
+                    continue
+                tarball = tarball_path(tmp, compression)
+                results.add("open_compressed_tarball", members, compression,
+                            measure(op_open_compressed_tarball, tarball))
+                results.add("check_tarball", members, compression,
+                            measure(op_check_tarball, manifest, tarball))
+                if apt_inst is not None:
+                    results.add("check_apt_tarball", members, compression,
+                                measure(op_check_apt_tarball, manifest,
+                                        tarball, compression))
+                os.unlink(tarball)
+
+    if args.output is not None:
+        results.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+Measure how the test scheduler scales with the number of worker processes,
+by running the same suite once for every requested -j value. The suite is
+either given, or generated (see make_workspace.py) with --synthetic.
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+
+from dpu.suite import TestSuite
+from dpu.runner import TestRunner
+from dpu.timing import stage_totals
+from dpu.utils import tmpdir
+
+from make_workspace import make_workspace
+
+
+def default_jobs():
+    jobs = []
+    j = 1
+    while j <= multiprocessing.cpu_count() * 2:
+        jobs.append(j)
+        j *= 2
+    return jobs
+
+
+def bench(suite, tests, jobs):
+    runner = TestRunner(suite, jobs=jobs)
+    started = time.time()
+    results = []
+    for result in runner.run(tests):
+        results.append(result)
+    elapsed = time.time() - started
+    return results, elapsed, runner.worker_stats
+
+
+def report(suite, tests, jobs_list):
+    base = None
+    stages = {}
+    print "%6s %8s %8s %10s %10s %8s %10s" % (
+        "jobs", "tests", "unpassed", "seconds", "tests/s", "speedup",
+        "efficiency")
+    for jobs in jobs_list:
+        results, elapsed, stats = bench(suite, tests, jobs)
+        count = len(results)
+        unpassed = len([x for x in results if x.status != "passed"])
+        if base is None:
+            base = elapsed
+        speedup = base / elapsed
+        busy = sum(s.busy for s in stats.values())
+        efficiency = busy / (elapsed * max(1, min(jobs, count)))
+        print "%6d %8d %8d %10.2f %10.2f %8.2f %9.0f%%" % (
+            jobs, count, unpassed, elapsed, count / elapsed, speedup,
+            efficiency * 100)
+        for stage, total in stage_totals(results).items():
+            stages.setdefault(stage, {})[jobs] = total["wall"] / count
+
+    # Per-stage wall time, in milliseconds per test
+    print ""
+    print "%-12s" % ("ms/test") + "".join(
+        "%10s" % ("-j %d" % (x)) for x in jobs_list)
+    for stage in sorted(stages, key=lambda x: -max(stages[x].values())):
+        print "%-12s" % (stage) + "".join(
+            "%10.2f" % (stages[stage].get(x, 0) * 1000) for x in jobs_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-j', type=int, nargs="*", default=default_jobs(),
+                        help='Worker counts to benchmark')
+    parser.add_argument('-t', type=str, nargs="*", default=[],
+                        help='Which tests to run')
+    parser.add_argument('--synthetic', type=int, default=None,
+                        help='Generate a workspace with this many tests')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Templates stacked in every synthetic test')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Files in every synthetic template')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Size of every synthetic file, in bytes')
+    parser.add_argument('--hooks', action='store_true', default=False,
+                        help='Give every synthetic test no-op hooks')
+    parser.add_argument('suite', default=".", nargs="?", help='Path')
+    args = parser.parse_args()
+
+    os.umask(0022)
+    if args.synthetic is None:
+        tests = args.t or TestSuite(args.suite).test_ids()
+        report(args.suite, tests, args.j)
+        return
+
+    with tmpdir() as tmp:
+        suite = os.path.join(tmp, "workspace")
+        make_workspace(suite, args.synthetic, depth=args.depth,
+                       files=args.files, size=args.size, hooks=args.hooks)
+        tests = args.t or TestSuite(suite).test_ids()
+        report(suite, tests, args.j)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+Time writing and reading back orig tarballs (dpu.tarball) for every
+compression, at a few compression levels and thread counts.
+"""
+
+import os
+import time
+import argparse
+
+from dpu.tarball import make_orig_tarball, open_compressed_tarball
+from dpu.utils import tmpdir, mkdir
+
+
+def make_tree(root, files, size):
+    for x in range(files):
+        dpath = os.path.join(root, "d%d" % (x % 10))
+        if not os.path.isdir(dpath):
+            mkdir(dpath)
+        with open(os.path.join(dpath, "f%d" % (x)), "wb") as fd:
+            # Half random, half repetitive, so the compressors have
+            # something to do.
+            fd.write(os.urandom(size / 2))
+            fd.write("dpu " * (size / 8))
+
+
+def read_all(tarball):
+    with open_compressed_tarball(tarball) as tar:
+        for tinfo in tar:
+            if tinfo.isfile():
+                tar.extractfile(tinfo).read()
+
+
+def bench(tmp, compression, level, threads, repeat):
+    write = []
+    read = []
+    for _ in range(repeat):
+        started = time.time()
+        tarball = make_orig_tarball(tmp, "bench", "1.0",
+                                    compression=compression,
+                                    outputdir=tmp, mtime=0,
+                                    level=level, threads=threads)
+        write.append(time.time() - started)
+        started = time.time()
+        read_all(tarball)
+        read.append(time.time() - started)
+        size = os.path.getsize(tarball)
+        os.unlink(tarball)
+    print "%-6s level %-4s threads %-4s write: %8.4fs  read: %8.4fs  " \
+        "size: %d" % (compression, level, threads, min(write), min(read),
+                      size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=65536,
+                        help='Size of every file, in bytes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compression', nargs="*",
+                        default=["gzip", "bzip2", "xz", "lzma", "zstd"])
+    parser.add_argument('--levels', type=int, nargs="*", default=[None])
+    parser.add_argument('--threads', type=int, nargs="*",
+                        default=[None, 0])
+    args = parser.parse_args()
+
+    with tmpdir() as tmp:
+        mkdir(os.path.join(tmp, "bench-1.0"))
+        make_tree(os.path.join(tmp, "bench-1.0"), args.files, args.size)
+        print "%d files of %d bytes" % (args.files, args.size)
+        for compression in args.compression:
+            for level in args.levels:
+                for threads in args.threads:
+                    try:
+                        bench(tmp, compression, level, threads, args.repeat)
+                    except (OSError, ValueError) as e:
+                        print "%-6s not available (%s), skipping" % (
+                            compression, e)
+
+
+if __name__ == "__main__":
+    main()
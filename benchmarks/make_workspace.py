@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+Generate a synthetic workspace with any number of tests, to benchmark the
+runner with. Its builder and checker are stubs that read the rendered
+source and write a fixed result, so what is measured is dpu itself rather
+than dpkg-buildpackage or lintian.
+"""
+
+import os
+import json
+import hashlib
+import argparse
+
+from dpu.utils import mkdir
+
+
+STUB_BUILDER = """#!/bin/sh
+# Stand-in for dpkg-buildpackage: read all of the source, and leave a
+# .changes (and the file it lists) next to it.
+cd "$1"
+name=$(basename "$PWD")
+find . -type f | sort | xargs cat | cksum > "../$name.stub"
+printf 'Source: %s\\nFiles:\\n 0 0 - - %s.stub\\n' "$name" "$name" \\
+    > "../$name.changes"
+"""
+
+STUB_CHECKER = """#!/bin/sh
+# Stand-in for lintian
+cd "$1/.."
+cat *.changes > /dev/null && echo "I: stub-check: ok" > stub-check
+"""
+
+STUB_CHECKER_VERSION = """#!/bin/sh
+echo "stub-check 1.0"
+"""
+
+CHECKER_OUTPUT = "I: stub-check: ok\n"
+
+
+def _write(path, content, mode=0644):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        mkdir(dirname)
+    with open(path, "w") as fd:
+        fd.write(content)
+    os.chmod(path, mode)
+
+
+def _content(name, size):
+    """
+    Some `size' bytes of text that differ from file to file.
+    """
+    line = hashlib.sha1(name).hexdigest() + "\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def make_template(path, name, files, size):
+    """
+    Write a template with `files' plain files of `size' bytes (spread over a
+    few directories) and a Jinja template to `path'.
+    """
+    for x in range(files):
+        fpath = os.path.join(path, "d%d" % (x % 8), "%s-f%d" % (name, x))
+        _write(fpath, _content("%s/%d" % (name, x), size))
+    _write(os.path.join(path, "debian", "%s.tpl" % (name)),
+           "{{ testname }} ({{ source }} {{ version.upstream }}), "
+           "from %s\n" % (name))
+
+
+def make_workspace(path, tests, depth=3, files=20, size=1024, hooks=False):
+    """
+    Write a workspace with `tests' tests to `path'. Every test stacks
+    `depth' workspace templates and one template of its own, each with
+    `files' files of `size' bytes. With `hooks', every test also has
+    (empty) hooks for all stages.
+    """
+    layers = ["layer%d" % (x) for x in range(depth)]
+    _write(os.path.join(path, "context.json"), json.dumps({
+        "suite-name": "synthetic",
+        "source": "pkgfoo",
+        "version": {"upstream": "1.0", "debian": "1", "epoch": None},
+        "date": "Sat, 18 Aug 2012 16:22:26 -0400",
+        "native": True,
+    }, indent=4, sort_keys=True))
+    for layer in layers:
+        make_template(os.path.join(path, "templates", layer), layer, files,
+                      size)
+    _write(os.path.join(path, "builders", "stub"), STUB_BUILDER, 0755)
+    _write(os.path.join(path, "checkers", "stub-check"), STUB_CHECKER, 0755)
+    _write(os.path.join(path, "checkers", "stub-check.version"),
+           STUB_CHECKER_VERSION, 0755)
+
+    for x in range(tests):
+        name = "test-%05d" % (x)
+        tpath = os.path.join(path, "tests", name)
+        _write(os.path.join(tpath, "test.json"), json.dumps({
+            "testname": name,
+            "templates": ["local"] + layers,
+            "builders": ["stub"],
+            "checkers": ["stub-check"],
+        }, indent=4, sort_keys=True))
+        _write(os.path.join(tpath, "stub-check"), CHECKER_OUTPUT)
+        make_template(os.path.join(tpath, "local"), name, files, size)
+        if hooks:
+            for hook in ("init", "tmpdir", "pre-build", "post-build",
+                         "pre-check", "post-check", "finally"):
+                _write(os.path.join(tpath, hook), "#!/bin/sh\n", 0755)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tests', type=int, default=100)
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Workspace templates stacked in every test')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Files in every template')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Size of every file, in bytes')
+    parser.add_argument('--hooks', action='store_true', default=False,
+                        help='Give every test a (no-op) hook for every stage')
+    parser.add_argument('path', help='Where to create the workspace')
+    args = parser.parse_args()
+
+    os.umask(0022)
+    make_workspace(args.path, args.tests, depth=args.depth, files=args.files,
+                   size=args.size, hooks=args.hooks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module contains an on-disk, content-addressed cache of build artifacts,
+so work that has already been done for identical inputs can be skipped.
+"""
+
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+
+from dpu.utils import mkdir, rmdir
+
+
+class ArtifactCache(object):
+    """
+    An ArtifactCache maps a key (a hash of all the inputs of some job) to the
+    set of files that job produced. Entries are evicted least-recently-used
+    first, once the cache grows past `max_size' bytes.
+
+    The cache is safe to share between worker processes; entries are staged
+    next to the cache and renamed into place, so readers never see a half
+    written entry.
+    """
+
+    def __init__(self, root, max_size=None):
+        """
+        `root' is the directory to keep the cache in (created on demand),
+        `max_size' the size (in bytes) to bound it to, or None for no bound.
+        """
+        self._root = os.path.abspath(root)
+        self.max_size = max_size
+        try:
+            mkdir(self._root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, *parts):
+        """
+        Combine `parts' (a number of strings) into a cache key.
+        """
+        h = hashlib.sha1()
+        for part in parts:
+            h.update(part)
+            h.update("\0")
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self._root, key[:2], key)
+
+    def restore(self, key, dest):
+        """
+        Copy the files stored under `key' into the directory `dest'. Returns
+        the list of restored file names, or None on a cache miss.
+        """
+        entry = self._entry(key)
+        try:
+            names = os.listdir(entry)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            for name in names:
+                shutil.copy2(os.path.join(entry, name),
+                             os.path.join(dest, name))
+            # Mark the entry as recently used.
+            os.utime(entry, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Evicted by someone else while we were copying it.
+            for name in names:
+                if os.path.exists(os.path.join(dest, name)):
+                    os.remove(os.path.join(dest, name))
+            return None
+        return names
+
+    def store(self, key, files):
+        """
+        Store the list of `files' (paths to regular files) under `key'.
+        """
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self._root)
+        try:
+            for path in files:
+                shutil.copy2(path, staging)
+            try:
+                mkdir(os.path.dirname(entry))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                os.rename(staging, entry)
+            except OSError as e:
+                # Someone else stored the same thing first; that's fine.
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            if os.path.exists(staging):
+                rmdir(staging)
+        self.evict()
+
+    def _entries(self):
+        """
+        Return a list of (last-use, size, path) tuples of all entries.
+        """
+        entries = []
+        for bucket in os.listdir(self._root):
+            if bucket.startswith("."):
+                continue
+            bpath = os.path.join(self._root, bucket)
+            for key in os.listdir(bpath):
+                epath = os.path.join(bpath, key)
+                try:
+                    mtime = os.stat(epath).st_mtime
+                    size = sum(os.path.getsize(os.path.join(epath, x))
+                               for x in os.listdir(epath))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                entries.append((mtime, size, epath))
+        return entries
+
+    def size(self):
+        """
+        The total size (in bytes) of everything in the cache.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the cache fits in
+        `max_size' again.
+        """
+        if self.max_size is None:
+            return
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, epath in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(epath, ignore_errors=True)
+            total -= size
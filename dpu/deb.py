@@ -0,0 +1,110 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module reads binary packages (.deb files) without python-apt. A .deb is
+an `ar' archive holding "debian-binary", "control.tar.*" and "data.tar.*";
+the members are streamed in order, so a whole package is read in a single
+sequential pass, and never copied.
+"""
+
+import errno
+from contextlib import contextmanager
+
+from dpu.tarball import open_compressed_tarball, _determine_compression
+
+
+AR_MAGIC = "!<arch>\n"
+AR_HEADER_SIZE = 60
+
+
+class ArMember(object):
+    """
+    A member of an `ar' archive, readable as a (forward only) file object.
+    It is only valid until the next member is asked for.
+    """
+
+    def __init__(self, fd, name, size, mtime, mode):
+        self._fd = fd
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self._left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        if size == 0:
+            return ""
+        data = self._fd.read(size)
+        if len(data) == 0:
+            raise IOError("Truncated ar member %s" % (self.name))
+        self._left -= len(data)
+        return data
+
+    def _skip(self):
+        """
+        Move the underlying file to the start of the next header, past
+        what's left of this member and its padding byte.
+        """
+        left = self._left + (self.size % 2)
+        self._left = 0
+        try:
+            self._fd.seek(left, 1)
+            return
+        except (AttributeError, IOError) as e:
+            if getattr(e, "errno", errno.ESPIPE) != errno.ESPIPE:
+                raise
+        while left > 0:
+            data = self._fd.read(min(left, 1 << 16))
+            if not data:
+                break
+            left -= len(data)
+
+
+def ar_members(fd):
+    """
+    Iterate over the members of the `ar' archive read from the file object
+    `fd', yielding an ArMember for each of them.
+    """
+    if fd.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError("Not an ar archive")
+    while True:
+        header = fd.read(AR_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) != AR_HEADER_SIZE or header[58:60] != "`\n":
+            raise ValueError("Malformed ar member header")
+        # GNU ar terminates names with a "/"
+        name = header[0:16].rstrip(" ").rstrip("/")
+        member = ArMember(fd, name, int(header[48:58]), int(header[16:28]),
+                          int(header[40:48], 8))
+        yield member
+        member._skip()
+
+
+@contextmanager
+def open_deb_tarball(debpath, part="data", fd=None):
+    """
+    Open the "control" or "data" tarball (named by `part') of the .deb
+    `debpath' as a TarFile, which can only be read in order. If `fd' is
+    given, the package is read from it rather than opened.
+    """
+    debfd = fd
+    if debfd is None:
+        debfd = open(debpath, "rb")
+    try:
+        prefix = "%s.tar" % (part)
+        for member in ar_members(debfd):
+            if member.name != prefix and \
+                    not member.name.startswith(prefix + "."):
+                continue
+            compression = _determine_compression(member.name)
+            with open_compressed_tarball(member.name, compression,
+                                         fd=member) as tar:
+                yield tar
+            return
+        raise ValueError("%s has no %s member" % (debpath, prefix))
+    finally:
+        if fd is None:
+            debfd.close()
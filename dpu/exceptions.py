@@ -73,3 +73,17 @@ class EntryPermissionAssertionError(ManifestCheckError):
     def __str__(self):
         return "%s is mode 0%o instead of 0%o" % (self.entry, self.actual,
                                                   self.expected)
+
+
+class ContentMismatchAssertionError(ManifestCheckError):
+    def __str__(self):
+        return "%s does not have the same content as %s" % (self.entry,
+                                                            self.expected)
+
+
+class HardlinkAssertionError(ManifestCheckError):
+    def __str__(self):
+        if self.actual is not None:
+            return "%s is a hardlink to %s instead of %s" % (
+                self.entry, self.actual, self.expected)
+        return "%s is not a hardlink to %s" % (self.entry, self.expected)
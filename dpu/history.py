@@ -0,0 +1,121 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module remembers how long every test took to run, so the tests can be
+split up into shards that take about as long as each other, and started
+longest first.
+"""
+
+import json
+
+from dpu.utils import save_config
+
+
+HISTORY_VERSION = 1
+
+# Expected duration (in seconds) of a test, when nothing has been recorded
+# about any test yet.
+DEFAULT_DURATION = 1.0
+
+
+class TimingHistory(object):
+    """
+    A TimingHistory keeps the last duration of each test in the JSON file
+    `path'.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._tests = None
+        self._dirty = False
+
+    def _load(self):
+        if self._tests is not None:
+            return self._tests
+        data = None
+        try:
+            with open(self._path) as fd:
+                data = json.load(fd)
+        except (IOError, ValueError):
+            # Missing or broken; all tests are alike then.
+            pass
+        if not isinstance(data, dict) or \
+                data.get("version") != HISTORY_VERSION:
+            data = {"version": HISTORY_VERSION, "tests": {}}
+        self._tests = data["tests"]
+        return self._tests
+
+    def estimates(self, test_ids):
+        """
+        Get a dict of the expected duration of each of `test_ids'. Tests
+        that haven't been run yet are expected to take the median duration
+        of those that have.
+        """
+        tests = self._load()
+        known = sorted(tests.values())
+        default = DEFAULT_DURATION
+        if known:
+            middle = len(known) // 2
+            default = known[middle]
+            if len(known) % 2 == 0:
+                default = (known[middle - 1] + default) / 2.0
+        return dict((x, tests.get(x, default)) for x in test_ids)
+
+    def record(self, test_id, duration):
+        """
+        Remember that the test `test_id' took `duration' seconds.
+        """
+        self._load()[test_id] = duration
+        self._dirty = True
+
+    def save(self):
+        """
+        Write the history back, if it changed.
+        """
+        if not self._dirty:
+            return
+        save_config(self._path, {"version": HISTORY_VERSION,
+                                 "tests": self._load()})
+        self._dirty = False
+
+
+def longest_first(test_ids, estimates):
+    """
+    Order `test_ids' by descending expected duration (going by the dict
+    `estimates'), so no long test is left to the end of a run while the
+    other workers sit idle. Ties are broken by the test id.
+    """
+    return sorted(test_ids, key=lambda x: (-estimates[x], x))
+
+
+def select_shard(test_ids, index, count, path=None):
+    """
+    Get the tests of shard number `index' of `count' (see shard). Only the
+    history in the file `path' is gone by, which has to be the same for all
+    shards (a history of just this machine won't do); without it, all tests
+    are expected to take the same time.
+    """
+    test_ids = list(test_ids)
+    estimates = dict.fromkeys(test_ids, DEFAULT_DURATION)
+    if path is not None:
+        estimates = TimingHistory(path).estimates(test_ids)
+    return shard(test_ids, estimates, index, count)
+
+
+def shard(test_ids, estimates, index, count):
+    """
+    Split `test_ids' into `count' shards of about the same expected
+    duration (going by the dict `estimates'), and return the tests of shard
+    number `index' (counting from 0).
+
+    Every test goes to the shard with the least work so far, longest test
+    first. Ties are broken by the test id and shard number, so every
+    machine comes up with the same shards given the same estimates.
+    """
+    loads = [0.0] * count
+    shards = [[] for _ in range(count)]
+    for test_id in longest_first(test_ids, estimates):
+        target = min(range(count), key=lambda x: (loads[x], x))
+        loads[target] += estimates[test_id]
+        shards[target].append(test_id)
+    return sorted(shards[index])
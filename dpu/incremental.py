@@ -0,0 +1,70 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module remembers the outcome of every test along with the fingerprint
+of its inputs (see Test.fingerprint), so a run can leave out the tests that
+passed last time and haven't changed since.
+"""
+
+import json
+
+from dpu.utils import save_config
+
+
+STATE_VERSION = 1
+
+
+class TestState(object):
+    """
+    A TestState keeps the last fingerprint and status of each test in the
+    JSON file `path'.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._tests = None
+        self._dirty = False
+
+    def _load(self):
+        if self._tests is not None:
+            return self._tests
+        data = None
+        try:
+            with open(self._path) as fd:
+                data = json.load(fd)
+        except (IOError, ValueError):
+            # Missing or broken; everything is run again.
+            pass
+        if not isinstance(data, dict) or \
+                data.get("version") != STATE_VERSION:
+            data = {"version": STATE_VERSION, "tests": {}}
+        self._tests = data["tests"]
+        return self._tests
+
+    def unchanged(self, test_id, fingerprint):
+        """
+        Check whether the test `test_id' passed last time, with the same
+        `fingerprint' it has now.
+        """
+        entry = self._load().get(test_id)
+        return entry is not None and entry["status"] == "passed" and \
+            entry["fingerprint"] == fingerprint
+
+    def record(self, test_id, fingerprint, status):
+        """
+        Remember that the test `test_id' had the `status' it had (see
+        TestResult.status) with the inputs described by `fingerprint'.
+        """
+        self._load()[test_id] = {"fingerprint": fingerprint,
+                                 "status": status}
+        self._dirty = True
+
+    def save(self):
+        """
+        Write the state back, if it changed.
+        """
+        if not self._dirty:
+            return
+        save_config(self._path, {"version": STATE_VERSION,
+                                 "tests": self._load()})
+        self._dirty = False
@@ -0,0 +1,123 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module keeps an on-disk index of the tests in a suite, so listing the
+tests and loading their test.json doesn't have to touch every one of them
+on every run.
+"""
+
+import os
+import json
+import errno
+
+from dpu.utils import load_config, save_config
+
+
+INDEX_VERSION = 1
+
+
+def _stamp(path):
+    """
+    Something that changes whenever the file `path' is replaced or
+    modified, or None if it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return [st.st_mtime, st.st_ino, st.st_size]
+
+
+class SuiteIndex(object):
+    """
+    A SuiteIndex stores the ids of the tests in the directory `tests_dir',
+    and the parsed test.json of each of them, in the JSON file `path'.
+
+    The list of tests is trusted as long as the mtime and inode of
+    `tests_dir' stay the same, and a parsed test.json as long as the mtime,
+    inode and size of the file do.
+    """
+
+    def __init__(self, path, tests_dir):
+        self._path = path
+        self._tests_dir = tests_dir
+        self._data = None
+        self._dirty = False
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        data = None
+        try:
+            with open(self._path) as fd:
+                data = json.load(fd)
+        except (IOError, ValueError):
+            # Missing or broken; start over.
+            pass
+        if not isinstance(data, dict) or \
+                data.get("version") != INDEX_VERSION:
+            data = {"version": INDEX_VERSION, "dir": None, "tests": {}}
+        self._data = data
+        return data
+
+    def test_ids(self):
+        """
+        Get the ids of all the tests, without listing the tests directory
+        unless it changed.
+        """
+        data = self._load()
+        st = os.stat(self._tests_dir)
+        stamp = [st.st_mtime, st.st_ino]
+        if data["dir"] != stamp:
+            tests = data["tests"]
+            ids = os.listdir(self._tests_dir)
+            for test_id in set(tests).difference(ids):
+                del tests[test_id]
+            for test_id in ids:
+                tests.setdefault(test_id, None)
+            data["dir"] = stamp
+            self._dirty = True
+        return sorted(data["tests"])
+
+    def context(self, test_id):
+        """
+        Get the parsed test.json of the test `test_id'.
+        """
+        tests = self._load()["tests"]
+        fpath = os.path.join(self._tests_dir, test_id, "test.json")
+        stamp = _stamp(fpath)
+        entry = tests.get(test_id)
+        if entry is not None and stamp is not None and \
+                entry["stamp"] == stamp:
+            return entry["context"]
+        context = load_config(fpath)
+        tests[test_id] = {"stamp": stamp, "context": context}
+        self._dirty = True
+        return context
+
+    def refresh(self):
+        """
+        Bring the index up to date with the suite, and save it if anything
+        changed. Returns the ids of all tests.
+        """
+        ids = self.test_ids()
+        for test_id in ids:
+            try:
+                self.context(test_id)
+            except (IOError, ValueError):
+                # Reported when the test is run
+                pass
+        self.save()
+        return ids
+
+    def save(self):
+        """
+        Write the index back, if it changed. The file is replaced
+        atomically, so concurrent readers never see half of it.
+        """
+        if not self._dirty:
+            return
+        save_config(self._path, self._data)
+        self._dirty = False
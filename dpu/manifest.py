@@ -2,6 +2,10 @@
 # license.
 
 import os
+import re
+import hashlib
+import sre_parse
+import sre_constants
 from functools import partial
 from collections import defaultdict
 
@@ -10,13 +14,22 @@ from dpu import (ENTRY_TYPE_DIR,
                  ENTRY_TYPE_FILE,
                  ENTRY_TYPE_SYMLINK)
 
-from dpu.utils import unix_perm
-from .exceptions import (InvalidManifestError,
+from dpu.utils import unix_perm, hash_file
+from dpu.deb import open_deb_tarball
+from .exceptions import (ManifestCheckError,
+                         InvalidManifestError,
                          SymlinkTargetAssertionError,
                          EntryPermissionAssertionError,
                          EntryPresentAssertionError,
                          EntryNotPresentAssertionError,
-                         EntryWrongTypeAssertionError)
+                         EntryWrongTypeAssertionError,
+                         ContentMismatchAssertionError,
+                         HardlinkAssertionError)
+
+# Content hashes of the members of recently checked artifacts, by
+# (path, device, inode, size, mtime) of the artifact; see MemberHashes.
+_artifact_hashes = {}
+_ARTIFACT_HASHES_MAX = 16
 
 
 def _split_usergroup(value):
@@ -32,33 +45,269 @@ def _split_usergroup(value):
     return (user, group)
 
 
+class ManifestEntry(object):
+    """
+    What a manifest says about a single path.  Attributes that the manifest
+    doesn't mention are None.
+    """
+
+    __slots__ = ("present", "entry_type", "link_target", "perm",
+                 "same_content")
+
+    def __init__(self):
+        self.present = None
+        self.entry_type = None
+        self.link_target = None
+        self.perm = None
+        # (keyword, path) of a file the entry must have the content of
+        self.same_content = None
+
+
+class ManifestEntries(dict):
+    """
+    The entries of a manifest, by path.  Looking up an unknown path creates
+    an (empty) entry for it.
+    """
+
+    __slots__ = ("patterns", "hardlinks", "_pattern_rules")
+
+    def __init__(self):
+        dict.__init__(self)
+        self.patterns = []
+        # Groups of entries that must be hardlinks of each other
+        self.hardlinks = []
+        self._pattern_rules = {}
+
+    def __missing__(self, path):
+        edata = ManifestEntry()
+        self[path] = edata
+        return edata
+
+    def pattern(self, pattern):
+        """
+        Return the PatternRule for `pattern', creating it if needed.
+        """
+        rule = self._pattern_rules.get(pattern)
+        if rule is None:
+            rule = PatternRule(pattern)
+            self._pattern_rules[pattern] = rule
+            self.patterns.append(rule)
+        return rule
+
+
+class PatternRule(ManifestEntry):
+    """
+    What a manifest says about all paths matching a glob or regular
+    expression.  If present is True, at least one path must match; every
+    match has to satisfy the rest.
+    """
+
+    __slots__ = ("pattern", "regex", "compiled")
+
+    def __init__(self, pattern):
+        ManifestEntry.__init__(self)
+        self.pattern = pattern
+        self.regex = _pattern_regex(pattern)
+        self.compiled = re.compile("(?:%s)\\Z" % self.regex)
+
+
+def _is_pattern(entry):
+    return entry.startswith("re:") or "*" in entry or "?" in entry or \
+        "[" in entry
+
+
+def _glob_regex(pattern):
+    """
+    Translate a glob into a regular expression.  "*" and "?" don't match
+    "/", but "**" matches anything.
+    """
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if pattern[i:i + 1] == "*":
+                i += 1
+                out.append(".*")
+            else:
+                out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = pattern.find("]", i + 1)
+            if j < 0:
+                out.append("\\[")
+                continue
+            cls = pattern[i:j]
+            if cls[:1] == "!":
+                cls = "^" + cls[1:]
+            out.append("[%s]" % cls.replace("\\", "\\\\"))
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return "".join(out)
+
+
+def _pattern_regex(pattern):
+    if pattern.startswith("re:"):
+        regex = pattern[3:]
+    else:
+        regex = _glob_regex(pattern)
+    try:
+        re.compile(regex)
+    except re.error as e:
+        raise InvalidManifestError("Invalid pattern %s: %s" % (pattern, e))
+    return regex
+
+
+def _edata(data, entry):
+    if _is_pattern(entry):
+        return data.pattern(entry)
+    return data[entry]
+
+
+_GROUP_REFS = (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS)
+_DEFAULT_FLAGS = re.compile("").flags
+
+
+def _refers_to_groups(tree):
+    """
+    Whether the parsed regular expression `tree' (or a part of it) has
+    backreferences, which only mean what they should in a regular
+    expression of their own.
+    """
+    if isinstance(tree, sre_parse.SubPattern):
+        return any(op in _GROUP_REFS or _refers_to_groups(av)
+                   for op, av in tree)
+    if isinstance(tree, (tuple, list)):
+        return any(_refers_to_groups(x) for x in tree)
+    return False
+
+
+def _combinable(rule):
+    """
+    Whether the pattern of `rule' can be part of a larger regular
+    expression: it has no backreferences, no named groups (which may clash
+    with those of other patterns) and no flags (which would apply to all
+    of it).
+    """
+    compiled = rule.compiled
+    if compiled.groupindex or compiled.flags != _DEFAULT_FLAGS:
+        return False
+    return not _refers_to_groups(sre_parse.parse(rule.regex))
+
+
+class _PatternMatcher(object):
+    """
+    All the patterns of a manifest, compiled into one regular expression
+    that quickly rejects paths no pattern matches, and a few that tell
+    which patterns match a path.  The latter consist of a lookahead per
+    pattern, each capturing an empty group when it matches; as Python
+    limits the number of groups in a regular expression, patterns are
+    split over as many of them as needed.  Every match is confirmed with
+    the regular expression of the pattern itself.
+
+    Patterns that don't survive being combined like this (see _combinable)
+    are matched one by one instead.
+    """
+
+    MAX_GROUPS = 99
+
+    def __init__(self, rules):
+        self._order = dict((x, i) for i, x in enumerate(rules))
+        self._separate = []
+        prefilters = []
+        self._matchers = []
+        alternatives = []
+        lookaheads = []
+        chunk_rules = []
+        groups = 0
+        for rule in rules:
+            if not _combinable(rule):
+                self._separate.append(rule)
+                continue
+            ngroups = rule.compiled.groups
+            if groups + ngroups + 1 > self.MAX_GROUPS and chunk_rules:
+                prefilters.append(alternatives)
+                self._add_matcher(lookaheads, chunk_rules)
+                alternatives = []
+                lookaheads = []
+                chunk_rules = []
+                groups = 0
+            alternatives.append("(?:%s)" % rule.regex)
+            lookaheads.append("(?:(?=(?:%s)\\Z)())?" % rule.regex)
+            groups += ngroups + 1
+            chunk_rules.append((groups, rule))
+        if chunk_rules:
+            prefilters.append(alternatives)
+            self._add_matcher(lookaheads, chunk_rules)
+        self._prefilters = [_compile_combined("(?:%s)\\Z" % "|".join(x))
+                            for x in prefilters]
+
+    def _add_matcher(self, lookaheads, chunk_rules):
+        self._matchers.append((_compile_combined("".join(lookaheads)),
+                               chunk_rules))
+
+    def match(self, name):
+        """
+        Return the list of rules whose pattern matches `name', in the order
+        of the manifest.
+        """
+        matched = set()
+        for prefilter, (regex, chunk_rules) in zip(self._prefilters,
+                                                   self._matchers):
+            if prefilter.match(name) is None:
+                continue
+            m = regex.match(name)
+            for group, rule in chunk_rules:
+                if m.group(group) is not None and \
+                        rule.compiled.match(name) is not None:
+                    matched.add(rule)
+        for rule in self._separate:
+            if rule.compiled.match(name) is not None:
+                matched.add(rule)
+        return sorted(matched, key=self._order.get)
+
+
+def _compile_combined(regex):
+    try:
+        return re.compile(regex)
+    except (re.error, AssertionError, OverflowError) as e:
+        raise InvalidManifestError("Cannot combine the patterns: %s" % (e))
+
+
 def _is_present(entry, edata, data, present=True):
-    if "present" in edata and edata["present"] != present:
+    if edata.present is not None and edata.present != present:
         raise InvalidManifestError(
             "%s cannot be present and not-present at the same time" % (entry))
-    edata["present"] = present
-    if present:
+    edata.present = present
+    if present and not isinstance(edata, PatternRule):
         # if entry is present, then so is the dir containing it
         dirpart, _ = os.path.split(entry)
         if not dirpart:
             # its parent is the "root", stop here
             return
         dedata = data[dirpart]
+        if dedata.present and dedata.entry_type == ENTRY_TYPE_DIR:
+            # Known already, and so are its parents
+            return
         # This will "create" the parent dirs recursively
         _is_file_type(dirpart, dedata, ENTRY_TYPE_DIR, data)
 
 
 def _is_file_type(entry, edata, etype, data):
     _is_present(entry, edata, data)
-    if "entry-type" in edata:
-        if edata["entry-type"] != etype:
+    if edata.entry_type is not None:
+        if edata.entry_type != etype:
             raise InvalidManifestError(
                 "%s cannot be a %s and a %s at the same time" % (
-                    entry, etype, edata["entry-type"]))
+                    entry, etype, edata.entry_type))
     else:
-        edata["entry-type"] = etype
+        edata.entry_type = etype
 
-    if etype == ENTRY_TYPE_SYMLINK and "perm" in edata:
+    if etype == ENTRY_TYPE_SYMLINK and edata.perm is not None:
         raise InvalidManifestError(
             "%s is expected to be a symlink, but has perm information" % (
                 entry
@@ -77,14 +326,17 @@ def _parse_link_target(data, cmd, last, arg):
     if target is None:
         raise InvalidManifestError("%s takes either one or two arguments" % (
             cmd))
+    if entry is not None and _is_pattern(entry):
+        raise InvalidManifestError("%s cannot be applied to a pattern" % (
+            cmd))
 
-    edata = data[entry]
+    edata = _edata(data, entry)
     _is_file_type(entry, edata, ENTRY_TYPE_SYMLINK, data)
-    if "link-target" in edata and edata["link-target"] != target:
+    if edata.link_target is not None and edata.link_target != target:
         raise InvalidManifestError(
             "%s cannot point to %s and %s at the same time" % (
-                entry, target, edata["link-target"]))
-    edata["link-target"] = target
+                entry, target, edata.link_target))
+    edata.link_target = target
     return entry
 
 
@@ -92,7 +344,7 @@ def _parse_not_present(data, cmd, last, arg):
     if not arg or len(arg.split(None, 1)) != 1:
         raise InvalidManifestError("%s takes exactly one argument" % cmd)
     entry = arg
-    edata = data[entry]
+    edata = _edata(data, entry)
     _is_present(entry, edata, data, present=False)
     return None
 
@@ -102,19 +354,19 @@ def _parse_contains_X(data, cmd, last, arg):
     if not arg or len(arg.split(None, 1)) != 1:
         raise InvalidManifestError("%s takes exactly one argument" % cmd)
     entry = arg
-    edata = data[entry]
+    edata = _edata(data, entry)
     _is_file_type(entry, edata, etype, data)
     return entry
 
 
 def _set_perm(entry, edata, mode, user, group):
-    if "entry-type" in edata and edata["entry-type"] == ENTRY_TYPE_SYMLINK:
+    if edata.entry_type == ENTRY_TYPE_SYMLINK:
         raise InvalidManifestError("%s cannot be applied to symlink entry" % (
             entry))
 
-    if "perm" in edata and edata["perm"] != mode:
+    if edata.perm is not None and edata.perm != mode:
         raise InvalidManifestError("Conflicting perm mode for %s" % entry)
-    edata["perm"] = mode
+    edata.perm = mode
 
     if user is not None:
         # TODO:
@@ -138,7 +390,7 @@ def _parse_contains_entry(data, cmd, last, arg):
     if entry is None:
         raise InvalidManifestError(
             "%s takes at least two and at most three arguments" % (cmd))
-    edata = data[entry]
+    edata = _edata(data, entry)
     ftype, mode = unix_perm(uperm)
     _is_file_type(entry, edata, ftype, data)
     _set_perm(entry, edata, mode, user, group)
@@ -155,7 +407,9 @@ def _parse_perm(data, cmd, last, arg):
         if len(args) > 0 and len(args) < 4:
             mode = int(args[0], 8)
             entry = last
-            if len(args) > 1:
+            if len(args) == 2 and _is_pattern(args[1]):
+                entry = args[1]
+            elif len(args) > 1:
                 user, group = _split_usergroup(args[1])
             if len(args) == 3:
                 entry = args[2]
@@ -164,15 +418,62 @@ def _parse_perm(data, cmd, last, arg):
         raise InvalidManifestError(
             "%s takes at least one and at most three arguments" % (cmd))
 
-    edata = data[entry]
-    _is_present(entry, edata, data)
+    edata = _edata(data, entry)
+    if not isinstance(edata, PatternRule):
+        # A perm pattern applies to whatever matches, if anything does.
+        _is_present(entry, edata, data)
     _set_perm(entry, edata, mode, user, group)
 
     return entry
 
 
-def _not_implemented(data, cmd, last, arg):
-    raise NotImplementedError("%s is not implemented" % cmd)
+def _parse_same_content(data, cmd, last, arg):
+    entry = last
+    source = None
+    if arg:
+        args = arg.split(None, 2)
+        if len(args) == 1 or len(args) == 2:
+            source = args[0]
+            if len(args) == 2:
+                entry = args[1]
+    if source is None or entry is None:
+        raise InvalidManifestError("%s takes either one or two arguments" % (
+            cmd))
+    if _is_pattern(entry):
+        raise InvalidManifestError("%s cannot be applied to a pattern" % (
+            cmd))
+    keyword = "WORKDIR"
+    if ":" in source and re.match(r"[A-Z]+:", source):
+        keyword, source = source.split(":", 1)
+        if keyword not in ("TESTDIR", "WORKDIR"):
+            raise InvalidManifestError(
+                "%s: unknown keyword %s (expected TESTDIR or WORKDIR)" % (
+                    cmd, keyword))
+
+    edata = data[entry]
+    _is_file_type(entry, edata, ENTRY_TYPE_FILE, data)
+    if edata.same_content is not None and \
+            edata.same_content != (keyword, source):
+        raise InvalidManifestError(
+            "%s cannot have the content of %s and %s at the same time" % (
+                entry, source, edata.same_content[1]))
+    edata.same_content = (keyword, source)
+    return entry
+
+
+def _parse_hardlinks(data, cmd, last, arg):
+    entries = []
+    if arg:
+        entries = arg.split()
+    if len(entries) < 2:
+        raise InvalidManifestError("%s takes at least two arguments" % (cmd))
+    for entry in entries:
+        if _is_pattern(entry):
+            raise InvalidManifestError("%s cannot be applied to a pattern" % (
+                cmd))
+        _is_file_type(entry, data[entry], ENTRY_TYPE_FILE, data)
+    data.hardlinks.append(tuple(_normname(x) for x in entries))
+    return None
 
 COMMANDS = {
     "contains-file": _parse_contains_X,
@@ -183,13 +484,18 @@ COMMANDS = {
     "perm": _parse_perm,
     "contains-entry": _parse_contains_entry,
 
-    "same-content": _not_implemented,
-    "hardlinks": _not_implemented,
+    "same-content": _parse_same_content,
+    "hardlinks": _parse_hardlinks,
 }
 
 
-def parse_manifest(fname):
-    data = defaultdict(dict)
+def parse_manifest(fname, workdir=None):
+    """
+    Parse the manifest `fname'.  Files named by same-content are looked up
+    relative to the directory of the manifest (TESTDIR) or to `workdir'
+    (WORKDIR; the current directory if None).
+    """
+    data = ManifestEntries()
     with open(fname) as f:
         last = None
         for line in (l.strip() for l in f):
@@ -201,61 +507,396 @@ def parse_manifest(fname):
             if len(spl) == 1:
                 spl.append(None)
             last = COMMANDS[spl[0]](data, spl[0], last, spl[1])
-    return Manifest(data)
+    return Manifest(data, testdir=os.path.dirname(os.path.abspath(fname)),
+                    workdir=workdir)
+
+
+def _normname(normtname):
+    if normtname == '.' or normtname == './':
+        return None
+    # If it has a leading /, keep it.  Regular tarballs usually don't, but
+    # it possible to do.
+    if normtname[0] != "/":
+        # technically incorrect with ../ or ./../ stuff, but a real tarball
+        # won't have that.
+        normtname = normtname.lstrip("./")
+    return normtname
+
+
+def _lookup(index, name):
+    """
+    Map the raw member name `name' to the entry name it is indexed under in
+    `index' (see Manifest._compile), or None if it's not in there.
+    """
+    if name in index:
+        return name
+    if name[:2] == "./":
+        # The other common spelling
+        if name[2:] in index:
+            return name[2:]
+    if name[:1] == ".":
+        # Unusual spellings such as "././foo"; take the slow path.
+        normtname = _normname(name)
+        if normtname in index:
+            return normtname
+    return None
+
+
+class MemberHashes(object):
+    """
+    The content hashes of the regular files in a tarball, computed while
+    it is read, so every member is read at most once however many checks
+    need it.  `known' may hold hashes from an earlier pass over the same
+    tarball, which are then not computed again (see artifact_hashes).
+    """
+
+    def __init__(self, tar, known=None):
+        self._tar = tar
+        if known is None:
+            known = {}
+        self.hashes = known
+
+    def add(self, normtname, tinfo, data=None):
+        """
+        Hash the member `tinfo' (called `normtname' once normalized), if
+        it's a regular file.  `data' is its content, if already at hand;
+        otherwise it's read from the tarball.
+        """
+        if not tinfo.isfile() or normtname in self.hashes:
+            return
+        h = hashlib.sha1()
+        if data is not None:
+            h.update(data)
+        else:
+            fd = self._tar.extractfile(tinfo)
+            for block in iter(lambda: fd.read(65536), b""):
+                h.update(block)
+        self.hashes[normtname] = h.hexdigest()
+
+    def get(self, normtname, tinfo):
+        """
+        The hash of the member `tinfo'; for hardlinks, that of the file
+        they link to.  None if it wasn't hashed.
+        """
+        if tinfo.islnk():
+            normtname = _normname(tinfo.linkname)
+        return self.hashes.get(normtname)
+
+
+def artifact_hashes(path, part=None):
+    """
+    Return the dict of member hashes kept for the tarball `part' (e.g.
+    "data") of the artifact (e.g. a .deb) `path', to pass on to
+    MemberHashes.  The dict is dropped as soon as the artifact changes.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), part, st.st_dev, st.st_ino, st.st_size,
+           st.st_mtime)
+    hashes = _artifact_hashes.get(key)
+    if hashes is None:
+        if len(_artifact_hashes) >= _ARTIFACT_HASHES_MAX:
+            _artifact_hashes.clear()
+        hashes = {}
+        _artifact_hashes[key] = hashes
+    return hashes
+
+
+def check_manifests(manifests, tar, known_hashes=None):
+    """
+    Check all of `manifests' against the members of the TarFile `tar', in a
+    single pass over it. Every member is only handed to the manifests that
+    mention it, and reading stops as soon as no manifest can change its
+    outcome any more.  `known_hashes' is passed on to MemberHashes.
+
+    Returns a list with the outcome for each manifest (in order): None if
+    it matched, or the ManifestCheckError it failed with.
+    """
+    hashes = None
+    if any(manifest._hashing() for manifest in manifests):
+        hashes = MemberHashes(tar, known_hashes)
+    checks = [manifest.start(hashes) for manifest in manifests]
+    interested = defaultdict(list)
+    for check in checks:
+        for entry in check.manifest._compile():
+            interested[entry].append(check)
+    patterned = [x for x in checks if x.manifest._matcher is not None]
+    pending = sum(1 for check in checks if not check.done)
+    for tinfo in tar:
+        if pending == 0:
+            break
+        if hashes is not None:
+            normtname = _normname(tinfo.name)
+            if normtname is not None:
+                hashes.add(normtname, tinfo)
+        normtname = _lookup(interested, tinfo.name)
+        if normtname is not None:
+            for check in interested[normtname]:
+                if not check.done:
+                    check.feed(normtname, tinfo)
+                    if check.done:
+                        pending -= 1
+        if patterned:
+            normtname = _normname(tinfo.name)
+            if normtname is None:
+                continue
+            for check in patterned:
+                if not check.done:
+                    check.feed_patterns(normtname, tinfo)
+                    if check.done:
+                        pending -= 1
+    return [check.finish() for check in checks]
+
+
+class ManifestCheck(object):
+    """
+    The state of checking a Manifest against one tarball. Members are
+    passed to feed() as they are read, and finish() gives the outcome.
+    """
+
+    def __init__(self, manifest, hashes=None):
+        manifest._compile()
+        self.manifest = manifest
+        self.hashes = hashes
+        self.missing = set(manifest._required)
+        self.unmatched = set(manifest._required_patterns)
+        # Members of hardlink groups: the (normalized) name of the file
+        # they link to, or None for regular files
+        self.links = {}
+        self.error = None
+
+    @property
+    def done(self):
+        """
+        True once the rest of the tarball can't change the outcome: the
+        check failed, or every expected entry has been seen and there are
+        no entries that must not be present (nor patterns, as any member
+        may match them).
+        """
+        if self.error is not None:
+            return True
+        return not self.missing and not self.manifest._exhaustive
+
+    def feed(self, normtname, tinfo):
+        """
+        Check the member `tinfo' (called `normtname' once normalized),
+        which must be mentioned in the manifest. The first failure is kept
+        in `error'.
+        """
+        mentry = self.manifest._data[normtname]
+        try:
+            self.manifest._check_tar_entry(mentry, normtname, tinfo)
+            if mentry.same_content is not None:
+                self._check_same_content(mentry, normtname, tinfo)
+        except ManifestCheckError as e:
+            self.error = e
+            return
+        if normtname in self.manifest._hardlinked:
+            target = None
+            if tinfo.islnk():
+                target = _normname(tinfo.linkname)
+            self.links[normtname] = target
+        self.missing.discard(normtname)
+
+    def _check_same_content(self, mentry, normtname, tinfo):
+        keyword, source = mentry.same_content
+        actual = self.hashes.get(normtname, tinfo)
+        expected = hash_file(self.manifest._source_path(keyword, source))
+        if actual != expected:
+            raise ContentMismatchAssertionError(normtname, source)
+
+    def _canonical(self, normtname):
+        """
+        Follow hardlinks to hardlinks (which tar doesn't create, but which
+        are possible) to the file they all link to.
+        """
+        seen = set()
+        target = self.links.get(normtname)
+        while target is not None and self.links.get(target) is not None:
+            if target in seen:
+                break
+            seen.add(target)
+            target = self.links[target]
+        return target
+
+    def _check_hardlinks(self):
+        for group in self.manifest._data.hardlinks:
+            regular = [x for x in group if self.links.get(x) is None]
+            if len(regular) > 1:
+                raise HardlinkAssertionError(regular[1], regular[0])
+            if not regular:
+                raise HardlinkAssertionError(group[0], group[1],
+                                             self._canonical(group[0]))
+            for entry in group:
+                if entry == regular[0]:
+                    continue
+                target = self._canonical(entry)
+                if target != regular[0]:
+                    raise HardlinkAssertionError(entry, regular[0], target)
+
+    def feed_patterns(self, normtname, tinfo):
+        """
+        Check the member `tinfo' (called `normtname' once normalized)
+        against the patterns of the manifest.
+        """
+        for rule in self.manifest._matcher.match(normtname):
+            if rule.entry_type is None and rule.perm is not None and \
+                    tinfo.issym():
+                # The mode of symlinks is meaningless
+                continue
+            try:
+                self.manifest._check_tar_entry(rule, normtname, tinfo)
+            except ManifestCheckError as e:
+                self.error = e
+                return
+            self.unmatched.discard(rule)
+
+    def finish(self):
+        """
+        Returns None if the manifest matched, and the ManifestCheckError it
+        failed with otherwise.
+        """
+        if self.error is None and self.missing:
+            self.error = EntryPresentAssertionError(sorted(self.missing)[0])
+        if self.error is None and self.unmatched:
+            first = [x for x in self.manifest._required_patterns
+                     if x in self.unmatched][0]
+            self.error = EntryPresentAssertionError(first.pattern)
+        if self.error is None:
+            try:
+                self._check_hardlinks()
+            except ManifestCheckError as e:
+                self.error = e
+        return self.error
 
 
 class Manifest(object):
-    def __init__(self, data):
+    def __init__(self, data, testdir=None, workdir=None):
         self._data = data
-
-    def check_tarball(self, tar):
-        data = self._data
-        missing = set(x for x in data if data[x]["present"])
+        self._testdir = testdir
+        self._workdir = workdir
+        self._hardlinked = frozenset(x for group in data.hardlinks
+                                     for x in group)
+        self._index = None
+        self._required = None
+        self._required_patterns = None
+        self._matcher = None
+        self._exhaustive = None
+        self._hashes_needed = None
+
+    def _compile(self):
+        """
+        Build (once) the index of entries a member name can be matched
+        against (see _lookup), the set of entries that must be present,
+        the matcher for the patterns, and whether the whole tarball has to
+        be read to rule out entries that must not be present.
+        """
+        if self._index is None:
+            data = self._data
+            # Entries that aren't spelled like _normname would can never
+            # match; usually there are none, and the entries are the index.
+            odd = [x for x in data if _normname(x) != x]
+            if odd:
+                index = frozenset(data).difference(odd)
+            else:
+                index = data
+            self._required = frozenset(x for x in data if data[x].present)
+            self._exhaustive = len(self._required) != len(data) or \
+                bool(data.patterns)
+            if data.patterns:
+                self._matcher = _PatternMatcher(data.patterns)
+            self._required_patterns = [x for x in data.patterns if x.present]
+            self._hashes_needed = any(data[x].same_content is not None
+                                      for x in self._required)
+            self._index = index
+        return self._index
+
+    def _hashing(self):
+        """
+        Whether checking this manifest needs the content hashes of the
+        regular files in the tarball.
+        """
+        self._compile()
+        return self._hashes_needed
+
+    def _source_path(self, keyword, source):
+        base = self._workdir
+        if keyword == "TESTDIR":
+            base = self._testdir
+        if base is None:
+            return source
+        return os.path.join(base, source)
+
+    def start(self, hashes=None):
+        return ManifestCheck(self, hashes)
+
+    def check_tarball(self, tar, known_hashes=None):
+        """
+        Check the TarFile `tar' against the manifest, and raise the
+        ManifestCheckError it fails with, if any.  `known_hashes' is passed
+        on to MemberHashes.
+        """
+        index = self._compile()
+        hashes = None
+        if self._hashing():
+            hashes = MemberHashes(tar, known_hashes)
+        check = self.start(hashes)
+        patterned = self._matcher is not None
         for tinfo in tar:
-            normtname = self._normname(tinfo.name)
-            if normtname is None or normtname not in data:
-                continue
-            self._check_tar_entry(data[normtname], normtname, tinfo)
-            missing.discard(normtname)
-        if missing:
-            first = sorted(missing)[0]
-            raise EntryPresentAssertionError(first)
+            if hashes is not None:
+                normtname = _normname(tinfo.name)
+                if normtname is not None:
+                    hashes.add(normtname, tinfo)
+            normtname = _lookup(index, tinfo.name)
+            if normtname is not None:
+                check.feed(normtname, tinfo)
+            if patterned and not check.done:
+                normtname = _normname(tinfo.name)
+                if normtname is not None:
+                    check.feed_patterns(normtname, tinfo)
+            if check.done:
+                break
+        error = check.finish()
+        if error is not None:
+            raise error
+
+    def check_deb(self, debpath, part="data"):
+        known = None
+        if self._hashing():
+            known = artifact_hashes(debpath, part)
+        with open_deb_tarball(debpath, part) as tar:
+            self.check_tarball(tar, known_hashes=known)
 
     def check_apt_tarball(self, tar):
-        data = self._data
-        missing = set(x for x in data if data[x]["present"])
-        tar.go(partial(self._apt_visit_tarball, missing))
-        if missing:
-            first = sorted(missing)[0]
-            raise EntryPresentAssertionError(first)
-
-    def _apt_visit_tarball(self, data, missing, tarmember, _):
-        normtname = self._normname(tarmember.name)
-        if normtname is None or normtname not in data:
-            return
-        self._check_tar_entry(data[normtname], normtname, tarmember)
-        missing.discard(normtname)
-
-    def _normname(self, normtname):
-        if normtname == '.' or normtname == './':
-            return None
-        # If it has a leading /, keep it.  Regular tarballs usually don't, but
-        # it possible to do.
-        if normtname[0] != "/":
-            # technically incorrect with ../ or ./../ stuff, but a real tarball
-            # won't have that.
-            normtname = normtname.lstrip("./")
-        return normtname
+        hashes = None
+        if self._hashing():
+            hashes = MemberHashes(None)
+        check = self.start(hashes)
+        tar.go(partial(self._apt_visit_tarball, check))
+        error = check.finish()
+        if error is not None:
+            raise error
+
+    def _apt_visit_tarball(self, check, tarmember, data):
+        if check.hashes is not None:
+            normtname = _normname(tarmember.name)
+            if normtname is not None:
+                check.hashes.add(normtname, tarmember, data)
+        normtname = _lookup(self._index, tarmember.name)
+        if normtname is not None and not check.done:
+            check.feed(normtname, tarmember)
+        if self._matcher is not None and not check.done:
+            normtname = _normname(tarmember.name)
+            if normtname is not None:
+                check.feed_patterns(normtname, tarmember)
 
     def _check_tar_entry(self, mentry, normtname, tarmember):
         assert mentry is not None
-        assert "present" in mentry
 
-        if not mentry["present"]:
+        if mentry.present is False:
             raise EntryNotPresentAssertionError(normtname)
 
-        if "entry-type" in mentry:
-            etype = mentry["entry-type"]
+        if mentry.entry_type is not None:
+            etype = mentry.entry_type
             ok = False
             if etype == ENTRY_TYPE_FILE:
                 ok = tarmember.isfile() or tarmember.islnk()
@@ -271,16 +912,16 @@ class Manifest(object):
             if not ok:
                 raise EntryWrongTypeAssertionError(normtname, etype)
 
-        if "link-target" in mentry:
+        if mentry.link_target is not None:
             assert tarmember.issym()
-            if mentry["link-target"] != tarmember.linkname:
+            if mentry.link_target != tarmember.linkname:
                 raise SymlinkTargetAssertionError(normtname,
-                                                  mentry["link-target"],
+                                                  mentry.link_target,
                                                   tarmember.linkname)
 
-        if "perm" in mentry:
+        if mentry.perm is not None:
             assert not tarmember.issym()
-            if mentry["perm"] != tarmember.mode:
+            if mentry.perm != tarmember.mode:
                 raise EntryPermissionAssertionError(normtname,
-                                                    mentry["perm"],
+                                                    mentry.perm,
                                                     tarmember.mode)
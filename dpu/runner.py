@@ -0,0 +1,162 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module schedules the tests of a suite onto a pool of worker processes
+and funnels their results back to the parent process.
+"""
+
+import os
+import time
+import traceback
+import multiprocessing
+
+from dpu.suite import TestSuite
+
+
+# Per-process state of a worker, set up by _worker_init.
+_suite = None
+_verbose = False
+
+
+class TestResult(object):
+    """
+    The outcome of running a single test, as sent from a worker back to the
+    scheduling process. `timings' are the stages of the test, as recorded
+    by its StageTimer.
+    """
+
+    def __init__(self, test_id, results, error, worker, started, ended,
+                 timings=None):
+        self.test_id = test_id
+        self.results = results
+        self.error = error
+        self.worker = worker
+        self.started = started
+        self.ended = ended
+        self.timings = timings or []
+
+    @property
+    def elapsed(self):
+        """
+        Wall clock time (in seconds) the worker spent on the test.
+        """
+        return self.ended - self.started
+
+    @property
+    def status(self):
+        """
+        One of "error" (the test blew up), "failed" (a checker did not
+        match), "skipped" (nothing was compared) or "passed".
+        """
+        if self.error is not None:
+            return "error"
+        stat = [self.results[x] for x in self.results]
+        if len(stat) == 0:
+            return "skipped"
+        if "failed" in stat:
+            return "failed"
+        return "passed"
+
+
+class WorkerStats(object):
+    """
+    Book-keeping about what a single worker process did during a run.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.tests = 0
+        self.busy = 0.0
+
+    def account(self, result):
+        self.tests += 1
+        self.busy += result.elapsed
+
+
+def _worker_init(workspace, verbose, suite_options):
+    """
+    Set up the suite once per worker process, rather than once per test.
+    """
+    global _suite, _verbose
+    _suite = TestSuite(workspace, **suite_options)
+    _verbose = verbose
+
+
+def _worker_run(test_id):
+    """
+    Run the test called `test_id' in the current worker, and return a
+    TestResult. Exceptions are caught and reported rather than raised, so a
+    broken test can't take the worker down with it.
+    """
+    started = time.time()
+    results = None
+    error = None
+    test = None
+    try:
+        test = _suite.get_test(test_id)
+        kwargs = {}
+        if _verbose:
+            kwargs['verbose'] = True
+        results = test.run(**kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    timings = None
+    if test is not None:
+        timings = test.timer.stages
+    return TestResult(test_id, results, error, os.getpid(), started,
+                      time.time(), timings=timings)
+
+
+class TestRunner(object):
+    """
+    The TestRunner runs tests of a workspace on `jobs' worker processes, and
+    hands back results in the order the tests finish. `suite_options' are
+    passed on to the TestSuite of every worker.
+    """
+
+    def __init__(self, workspace, jobs=1, verbose=False, suite_options=None):
+        self._workspace = workspace
+        self.jobs = jobs
+        self.verbose = verbose
+        self._suite_options = suite_options or {}
+        self.worker_stats = {}
+
+    def _account(self, result):
+        stats = self.worker_stats.get(result.worker)
+        if stats is None:
+            stats = WorkerStats(result.worker)
+            self.worker_stats[result.worker] = stats
+        stats.account(result)
+
+    def _run_serial(self, test_ids):
+        _worker_init(self._workspace, self.verbose, self._suite_options)
+        for test_id in test_ids:
+            yield _worker_run(test_id)
+
+    def _run_pool(self, test_ids):
+        jobs = min(self.jobs, len(test_ids))
+        pool = multiprocessing.Pool(jobs, _worker_init,
+                                    (self._workspace, self.verbose,
+                                     self._suite_options))
+        try:
+            for result in pool.imap_unordered(_worker_run, test_ids, 1):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def run(self, test_ids):
+        """
+        Run the tests named in `test_ids', yielding a TestResult for each of
+        them as soon as it is done. With only one job, the tests are run in
+        this process.
+        """
+        test_ids = list(test_ids)
+        if self.jobs <= 1 or len(test_ids) <= 1:
+            results = self._run_serial(test_ids)
+        else:
+            results = self._run_pool(test_ids)
+        for result in results:
+            self._account(result)
+            yield result
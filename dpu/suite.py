@@ -3,13 +3,71 @@
 """
 This module manages the test workspace, and helps manage the tests.
 """
-from dpu.templates import TemplateManager, JinjaTemplate
+from dpu.templates import (TemplateManager, JinjaTemplate, SnapshotStore,
+                           set_bytecode_cache)
+from dpu.cache import ArtifactCache
+from dpu.index import SuiteIndex
+from dpu.timing import StageTimer
 from dpu.exceptions import (InvalidTemplate, NoSuchCallableError,
                             InvalidContextFile)
 from dpu.utils import (load_config, abspath, tmpdir,
                        mkdir, run_builder, run_checker,
-                       diff, run_command)
+                       diff, same_content, run_command, hash_file, hash_tree,
+                       changes_files, command_output, free_space)
+from email.utils import parsedate_tz, mktime_tz
+from collections import Mapping
 import os
+import json
+import hashlib
+
+
+class LayeredContext(Mapping):
+    """
+    A read-only context made of a stack of layers (dicts); a key is looked
+    up in each layer in turn, so earlier layers take precedence over later
+    ones. Layers are shared, not copied, so they must not be modified.
+    """
+
+    def __init__(self, *layers):
+        self._layers = layers
+        self._keys = None
+
+    def __getitem__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return True
+        return False
+
+    def _key_list(self):
+        if self._keys is None:
+            keys = []
+            seen = set()
+            for layer in self._layers:
+                for key in layer:
+                    if key not in seen:
+                        seen.add(key)
+                        keys.append(key)
+            self._keys = keys
+        return self._keys
+
+    def __iter__(self):
+        return iter(self._key_list())
+
+    def __len__(self):
+        return len(self._key_list())
+
+    def below(self, layer):
+        """
+        Get a new LayeredContext with `layer' added with the lowest
+        precedence.
+        """
+        return LayeredContext(*(self._layers + (layer,)))
 
 
 class Test(object):
@@ -18,25 +76,28 @@ class Test(object):
     and running the test.
     """
 
-    def __init__(self, path, test_id, workspace):
+    def __init__(self, path, test_id, workspace, context=None):
         """
         We require three arguments - a path to the test, a unique id, and the
-        workspace object we fall back on.
+        workspace object we fall back on. The parsed test.json may be passed
+        in as `context', if it is at hand already.
         """
         self._test_path = path
-        self._context = load_config("%s/test.json" % (path))
+        if context is None:
+            context = load_config("%s/test.json" % (path))
+        self._context = LayeredContext(context)
         self._workspace = workspace
+        self._context_resolved = False
         self._update_context()
         self.test_id = test_id
+        self.timer = StageTimer()
 
     def set_global_context(self, config):
         """
         Re-set the global context (or rather, set the context to this, updated
-        with the current context).
+        with the current context). `config' is shared, not copied.
         """
-        cfg = config.copy()
-        cfg.update(self._context)
-        self._context = cfg
+        self._context = self._context.below(config)
         self._update_context()
 
     def _update_context(self):
@@ -63,17 +124,54 @@ class Test(object):
         pkgname, version = self.get_source_and_version()
         version = version['upstream']
 
+        # Consecutive workspace templates are collected, so the suite can
+        # hand out a snapshot of them rather than rendering them again.
+        shared = []
+        snapshots = self._workspace.snapshots
         for template in ctx['templates']:
             if template == "shim:upstream":
                 if native:
                     raise InvalidTemplate("shim:upstream")
-                tm.add_template("UpstreamShim", pkgname, version)
+                self._add_shared_templates(tm, shared)
+                tm.add_template("UpstreamShim", pkgname, version,
+                                mtime=self._timestamp(),
+                                cache=self._workspace.orig_cache)
                 tm.add_template("DebianShim")
             else:
                 tobj = self._template_search(template)
+                if snapshots is not None and self.get_template(
+                        template) is None:
+                    shared.append(tobj)
+                    continue
+                self._add_shared_templates(tm, shared)
                 tm.add_real_template(tobj)
+        self._add_shared_templates(tm, shared)
         return tm
 
+    def _add_shared_templates(self, tm, shared):
+        """
+        Add the run of workspace templates `shared' (if any) to the
+        TemplateManager `tm' as a snapshot, and empty the list.
+        """
+        if shared:
+            tm.add_real_template(
+                self._workspace.snapshots.get(shared, self._context))
+        del shared[:]
+
+    def _timestamp(self):
+        """
+        Get the "date" of the test context as a unix timestamp, or None if
+        it is not set. Generated files use it, so they are the same on
+        every run.
+        """
+        date = self._context.get('date')
+        if date is None:
+            return None
+        parsed = parsedate_tz(date)
+        if parsed is None:
+            return None
+        return mktime_tz(parsed)
+
     def get_template(self, name):
         """
         Get the template by the name of `name`, and return that, or None.
@@ -100,35 +198,139 @@ class Test(object):
     def _run_hook(self, stage, path="."):
         bin_path = "%s/%s" % (self._test_path, stage)
         if os.path.exists(bin_path):
-            run_command([bin_path, path],
-                        output=True)
+            with self.timer.stage(stage):
+                run_command([bin_path, path],
+                            output=True)
 
-    def _run_checks(self):
+    def _artifacts_digest(self, tmp):
+        """
+        Hash the .changes files in `tmp', and all the files they reference.
+        Returns None if there are no .changes files to go by.
+        """
+        changes = sorted(x for x in os.listdir(tmp) if x.endswith(".changes"))
+        if not changes:
+            return None
+        parts = []
+        for name in changes:
+            fpath = os.path.join(tmp, name)
+            parts.append("%s %s" % (name, hash_file(fpath)))
+            for ref in sorted(changes_files(fpath)):
+                rpath = os.path.join(tmp, ref)
+                if os.path.exists(rpath):
+                    parts.append("%s %s" % (ref, hash_file(rpath)))
+        return "\n".join(parts)
+
+    def _run_checks(self, tmp):
+        """
+        Run all the checkers on the build products in `tmp'. If the suite
+        has a check cache, and the very same artifacts have been checked by
+        the very same version of the checker before, its output is restored
+        from the cache instead.
+        """
         # XXX: TODO: If check is a list, put together a pipeline.
         checks = self._context['checkers']
+        cache = self._workspace.check_cache
+        artifacts = None
+        if cache is not None:
+            artifacts = self._artifacts_digest(tmp)
+
         for check in checks:
             path = self._workspace._look_up('checkers', check)
+            if artifacts is None:
+                run_checker(path, self.path)
+                continue
+
+            key = cache.key(artifacts, check, self._workspace.file_hash(path),
+                            self._workspace.checker_version(check))
+            if cache.restore(key, tmp) is not None:
+                continue
             run_checker(path, self.path)
+            output = os.path.join(tmp, check)
+            if os.path.isfile(output):
+                cache.store(key, [output])
 
-    def _run_builds(self):
+    def _run_builds(self, tmp):
+        """
+        Run all the builders on the rendered source in `tmp'. If the suite
+        has a build cache, and the very same tree has been built by the very
+        same builders before, the build products are restored from the cache
+        instead.
+        """
         builds = self._context['builders']
-        for build in builds:
-            path = self._workspace._look_up('builders', build)
+        paths = [self._workspace._look_up('builders', x) for x in builds]
+        cache = self._workspace.build_cache
+        if cache is None:
+            for path in paths:
+                run_builder(path, self.path)
+            return
+
+        key = cache.key(hash_tree(tmp),
+                        *(b + self._workspace.file_hash(p)
+                          for b, p in zip(builds, paths)))
+        if cache.restore(key, tmp) is not None:
+            return
+
+        before = dict((x, os.stat(os.path.join(tmp, x)).st_mtime)
+                      for x in os.listdir(tmp))
+        for path in paths:
             run_builder(path, self.path)
+        products = []
+        for name in os.listdir(tmp):
+            fpath = os.path.join(tmp, name)
+            if not os.path.isfile(fpath) or os.path.islink(fpath):
+                continue
+            if before.get(name) != os.stat(fpath).st_mtime:
+                products.append(fpath)
+        cache.store(key, products)
 
-    def run(self, verbose=False):
+    def _resolve_context(self):
+        """
+        Add the contexts of the templates in the stack to the context
+        (once).
+        """
+        if self._context_resolved:
+            return
         templates = self._context['templates'][:]
         templates.reverse()
 
         for template in templates:
-            template = "%s.json" % (template)
-
-            try:
-                context = self._workspace._look_up('contexts', template)
-                context = load_config(context)
+            context = self._workspace.template_context(template)
+            if context is not None:
                 self.set_global_context(context)
-            except NoSuchCallableError as e:
-                pass
+        self._context_resolved = True
+
+    def fingerprint(self):
+        """
+        Get a hash of everything that goes into the test: the test directory
+        (including its hooks and expected output), the resolved context, the
+        templates in the stack, and the builders and checkers (and the
+        versions of the latter). If it is the same as last time, so is the
+        outcome of the test.
+        """
+        self._resolve_context()
+        ws = self._workspace
+        parts = [self.test_id, ws.tree_hash(self._test_path),
+                 json.dumps(dict(self._context), sort_keys=True)]
+        for template in self._context['templates']:
+            if os.path.exists(os.path.join(self._test_path, template)):
+                # Part of the test directory
+                continue
+            parts.append(ws.thing_hash('templates', template))
+        for builder in self._context['builders']:
+            parts.append(ws.thing_hash('builders', builder))
+        for checker in self._context['checkers']:
+            parts.append(ws.thing_hash('checkers', checker))
+            parts.append(ws.checker_version(checker))
+        return hashlib.sha1("\0".join(parts)).hexdigest()
+
+    def run(self, verbose=False):
+        """
+        Run the test, and return the outcome of every checker. How long
+        each stage took is recorded in `timer'.
+        """
+        timer = self.timer
+        with timer.stage("context"):
+            self._resolve_context()
 
         self._run_hook("init")
 
@@ -137,22 +339,36 @@ class Test(object):
 
         source, version = self.get_source_and_version()
         version = version['upstream']
-        tm = self.get_template_stack()
-        with tmpdir() as tmp:
+        with timer.stage("templates"):
+            tm = self.get_template_stack()
+        with tmpdir(self._workspace.workspace_root()) as tmp:
             self.path = "%s/%s-%s" % (tmp, source, version)
             path = self.path
             mkdir(path)
             self._run_hook("tmpdir", path=tmp)
-            tm.render(path)
+            with timer.stage("render"):
+                tm.render(path)
 
             self._run_hook("pre-build", path=path)
-            self._run_builds()
+            with timer.stage("build"):
+                self._run_builds(tmp)
             self._run_hook("post-build", path=path)
 
             self._run_hook("pre-check", path=path)
-            self._run_checks()
+            with timer.stage("check"):
+                self._run_checks(tmp)
             self._run_hook("post-check", path=path)
 
+            results = self._compare(tmp, verbose)
+            self._run_hook("finally", path=path)
+        return results
+
+    def _compare(self, tmp, verbose):
+        """
+        Compare the output of every checker in `tmp' with what the test
+        expects.
+        """
+        with self.timer.stage("compare"):
             results = {}
             for checker in self._context['checkers']:
                 pristine = "%s/%s" % (self._test_path, checker)
@@ -160,35 +376,76 @@ class Test(object):
                 if os.path.exists(pristine):
                     # OK, let's verify
                     if os.path.exists(output):
-                        with open("/dev/null", "w") as null:
-                            if diff(pristine, output,
-                                    output_fd=null):
-                                results[checker] = "passed"
-                            else:
-                                results[checker] = "failed"
-                                if verbose:
-                                    print "================================"
-                                    print "Checker match failure:"
-                                    print "  -> %s" % (self.name)
-                                    print "  -> %s" % (checker)
-                                    print "--------------------------------"
-                                    diff(pristine, output)
-                                    print "================================"
+                        if same_content(pristine, output):
+                            results[checker] = "passed"
+                        else:
+                            results[checker] = "failed"
+                            if verbose:
+                                print "================================"
+                                print "Checker match failure:"
+                                print "  -> %s" % (self.name)
+                                print "  -> %s" % (checker)
+                                print "--------------------------------"
+                                diff(pristine, output)
+                                print "================================"
                     else:
                         results[checker] = "no-output"
                 else:
                     results[checker] = "no-pristine"
-            self._run_hook("finally", path=path)
         return results
 
 
 class TestSuite(object):
-    def __init__(self, workspace):
+    def __init__(self, workspace, cache=None, cache_size=None,
+                 workspace_root=None, workspace_min_free=0,
+                 snapshot_dir=None, snapshot_mode="reflink", index=None):
         """
-        The only argument `workspace' is given the root of the test directory.
+        The argument `workspace' is given the root of the test directory.
+
+        If `cache' is given, it is a directory in which build products,
+        checker output and orig tarballs are kept between runs, each bounded
+        to `cache_size' bytes. Compiled Jinja templates are kept there as
+        well.
+
+        If `workspace_root' is given, tests are run in temporary directories
+        below it (e.g. a tmpfs) as long as it has at least
+        `workspace_min_free' bytes available.
+
+        If `snapshot_dir' is given, runs of workspace templates are rendered
+        once into snapshots there, and cloned into each test. With a
+        `snapshot_mode' of "hardlink", clones may be hardlinks when the
+        filesystem can't do reflinks.
+
+        If `index' is given, it is the path of a file to keep an index of
+        the tests and their parsed test.json in (see SuiteIndex).
         """
         self._workspace_path = abspath(workspace)
+        self._workspace_root = workspace_root
+        self._workspace_min_free = workspace_min_free
+        self.snapshots = None
+        if snapshot_dir is not None:
+            self.snapshots = SnapshotStore(
+                snapshot_dir, hardlink=(snapshot_mode == "hardlink"))
+        self.build_cache = None
+        self.check_cache = None
+        self.orig_cache = None
+        if cache is not None:
+            self.build_cache = ArtifactCache(os.path.join(cache, "builds"),
+                                             max_size=cache_size)
+            self.check_cache = ArtifactCache(os.path.join(cache, "checks"),
+                                             max_size=cache_size)
+            self.orig_cache = ArtifactCache(os.path.join(cache, "orig"),
+                                            max_size=cache_size)
+            set_bytecode_cache(os.path.join(cache, "jinja"))
+        self._checker_versions = {}
+        self._look_ups = {}
+        self._template_contexts = {}
+        self._file_hashes = {}
+        self._tree_hashes = {}
         self._test_dir = "%s/tests" % (workspace)
+        self._index = None
+        if index is not None:
+            self._index = SuiteIndex(index, self._test_dir)
         context_file = os.path.join(workspace, "context.json")
         self._context = load_config(context_file)
         self._workspace = workspace
@@ -216,26 +473,119 @@ class TestSuite(object):
         exists.
 
         Thing is (usually) one of "templates", "builders" or
-        "checkers".
+        "checkers".  Results are remembered for the life time of the
+        suite.
+        """
+        key = (thing, name)
+        if key not in self._look_ups:
+            found = None
+            for base in (self._workspace_path, "/usr/share/dpu"):
+                path = os.path.join(base, thing, name)
+                if os.path.exists(path):
+                    found = path
+                    break
+            self._look_ups[key] = found
+        path = self._look_ups[key]
+        if path is None:
+            raise NoSuchCallableError("No %s called %s available"
+                                      % (thing, name))
+        return path
+
+    def template_context(self, template):
+        """
+        Get the (parsed) context that comes with the template `template',
+        or None if it has none. It's shared between tests, so it must not
+        be modified.
+        """
+        if template not in self._template_contexts:
+            try:
+                path = self._look_up('contexts', "%s.json" % (template))
+                context = load_config(path)
+            except NoSuchCallableError:
+                context = None
+            self._template_contexts[template] = context
+        return self._template_contexts[template]
+
+    def file_hash(self, path):
         """
-        for base in (self._workspace_path, "/usr/share/dpu"):
-            path = os.path.join(base, thing, name)
-            if os.path.exists(path):
-                return path
-        raise NoSuchCallableError("No %s called %s available"
-                                  % (thing, name))
+        Get the hash of the content of the file `path' (e.g. a builder),
+        which is not expected to change while the suite is used.
+        """
+        if path not in self._file_hashes:
+            self._file_hashes[path] = hash_file(path)
+        return self._file_hashes[path]
+
+    def tree_hash(self, path):
+        """
+        Like file_hash, but for the directory tree `path'.
+        """
+        if path not in self._tree_hashes:
+            self._tree_hashes[path] = hash_tree(path)
+        return self._tree_hashes[path]
+
+    def thing_hash(self, thing, name):
+        """
+        Get a hash of the "thing" called "name" (see _look_up), be it a
+        script or a directory.
+        """
+        try:
+            path = self._look_up(thing, name)
+        except NoSuchCallableError:
+            return "%s %s missing" % (thing, name)
+        if os.path.isdir(path):
+            return "%s %s" % (path, self.tree_hash(path))
+        return "%s %s" % (path, self.file_hash(path))
+
+    def workspace_root(self):
+        """
+        Get the directory a test about to be run should put its temporary
+        directory in. This is the `workspace_root' the suite was created
+        with, unless it is running out of space, in which case it is None
+        (the default temporary directory).
+        """
+        root = self._workspace_root
+        if root is None or free_space(root) < self._workspace_min_free:
+            return None
+        return root
+
+    def checker_version(self, name):
+        """
+        Get the version of the tool behind the checker `name'. This is the
+        output of the "<name>.version" script next to the checker, or an
+        empty string if there is no such script.
+        """
+        if name not in self._checker_versions:
+            try:
+                path = self._look_up('checkers', "%s.version" % (name))
+                version = command_output([path])
+            except NoSuchCallableError:
+                version = ""
+            self._checker_versions[name] = version
+        return self._checker_versions[name]
 
     def get_test(self, test):
         """
         Get a single test by the name of `test`.
         """
         fpath = os.path.join(self._test_dir, test)
-        tobj = Test(fpath, test, self)
+        context = None
+        if self._index is not None:
+            context = self._index.context(test)
+        tobj = Test(fpath, test, self, context=context)
         tobj.set_global_context(self._context)
         return tobj
 
+    def test_ids(self):
+        """
+        Get the ids of all the tests to be handled. With an index, this
+        also brings it up to date.
+        """
+        if self._index is not None:
+            return self._index.refresh()
+        return os.listdir(self._test_dir)
+
     def tests(self):
         """
         Get all the test to be handled
         """
-        return (self.get_test(t) for t in os.listdir(self._test_dir))
+        return (self.get_test(t) for t in self.test_ids())
@@ -2,13 +2,51 @@
 # license.
 
 import os
+import bz2
+import gzip
 import tarfile
+import threading
 import subprocess
 from contextlib import contextmanager
 
+from dpu.utils import which
+
+# In-process xz/lzma and zstd support is optional; without the modules we
+# pipe through the command line tools instead.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# compression -> file extension
+EXTENSIONS = {
+    "gzip": "gz",
+    "bzip2": "bz2",
+    "xz": "xz",
+    "lzma": "lzma",
+    "zstd": "zst",
+}
+
+# compression -> multi-threaded command line compressor
+_PARALLEL_COMPRESSORS = {
+    "gzip": "pigz",
+    "bzip2": "pbzip2",
+    "xz": "xz",
+    "zstd": "zstd",
+}
+
 
 def make_orig_tarball(rundir, upname, upversion, compression="gzip",
-                      outputdir=None):
+                      outputdir=None, mtime=None, level=None, threads=None):
     """Create an orig tarball in the rundir
 
     This function will create a tarball suitable for being used as an
@@ -22,12 +60,22 @@ def make_orig_tarball(rundir, upname, upversion, compression="gzip",
 
     The optional "compression" parameter can be used to choose the
     compression of the tarball.  Supported values are "gzip", "bzip2",
-    "xz" and "lzma".  NB: For non-native 1.0 source packages, only
-    "gzip" should be used.
+    "xz", "lzma" and "zstd".  NB: For non-native 1.0 source packages,
+    only "gzip" should be used.
+
+    The optional "level" and "threads" parameters are passed on to the
+    compressor (see _open_writeable_tarfile).
+
+    If "mtime" is given, the tarball is byte-for-byte reproducible: the
+    members are added in sorted order, are owned by root, all have
+    "mtime" as their timestamp, and the compressor does not embed the
+    current time either.
 
     Caveat: The function assumes anything in the "source" directory to
     be a part of the "upstream code".  Thus, if a debian/ dir is
     present it will be a part of the "upstream" tarball.
+
+    Returns the path to the tarball.
     """
     unpackdir = "%s-%s" % (upname, upversion)
     unpackpath = os.path.join(rundir, unpackdir)
@@ -37,8 +85,194 @@ def make_orig_tarball(rundir, upname, upversion, compression="gzip",
         upname,
         upversion
     ))
-    with _open_writeable_tarfile(orig_tarball, compression) as tarobj:
-        tarobj.add(unpackpath, arcname=unpackdir)
+    with _open_writeable_tarfile(orig_tarball, compression, mtime=mtime,
+                                 level=level, threads=threads) as tarobj:
+        if mtime is None:
+            tarobj.add(unpackpath, arcname=unpackdir)
+        else:
+            _add_reproducibly(tarobj, unpackpath, unpackdir, mtime)
+    return tarobj.name
+
+
+def _add_reproducibly(tarobj, path, arcname, mtime):
+    """Recursively add path to tarobj, independent of ownership,
+    timestamps and directory order
+    """
+    tinfo = tarobj.gettarinfo(path, arcname)
+    tinfo.uid = tinfo.gid = 0
+    tinfo.uname = tinfo.gname = "root"
+    tinfo.mtime = mtime
+    if tinfo.isreg():
+        with open(path, "rb") as fd:
+            tarobj.addfile(tinfo, fd)
+    else:
+        tarobj.addfile(tinfo)
+    if tinfo.isdir():
+        for name in sorted(os.listdir(path)):
+            _add_reproducibly(tarobj, os.path.join(path, name),
+                              "%s/%s" % (arcname, name), mtime)
+
+
+class _CompressorFile(object):
+    """Write-only file object compressing into another file object
+
+    compressor is anything with the compress/flush interface of
+    zlib/bz2/lzma compressors.
+    """
+
+    def __init__(self, fileobj, compressor):
+        self._fileobj = fileobj
+        self._compressor = compressor
+
+    def write(self, data):
+        self._fileobj.write(self._compressor.compress(data))
+
+    def close(self):
+        self._fileobj.write(self._compressor.flush())
+
+
+class _DecompressorFile(object):
+    """Read-only file object decompressing another file object
+
+    factory is called to create a decompressor with the decompress
+    interface of the bz2/lzma decompressors.  When the decompressor
+    reaches the end of a stream and there is data left, a new one is
+    created to handle concatenated streams.
+    """
+
+    def __init__(self, fileobj, factory):
+        self._fileobj = fileobj
+        self._factory = factory
+        self._decomp = factory()
+        self._pending = b""
+        self._offset = 0
+
+    def read(self, size=-1):
+        # We may return less than size; tarfile's streams cope with that,
+        # as long as we only return "" at the end.  We must not return
+        # more though: they keep the excess around and copy it again on
+        # every read, which is quadratic in the size of our chunks (and
+        # highly compressed ones are large).
+        if self._offset >= len(self._pending):
+            self._pending = self._decompress()
+            self._offset = 0
+        end = len(self._pending)
+        if size >= 0:
+            end = min(end, self._offset + size)
+        data = self._pending[self._offset:end]
+        self._offset = end
+        return data
+
+    def _decompress(self):
+        """Returns the next (non-empty) chunk of data, or "" at the end"""
+        while True:
+            data = self._fileobj.read(1 << 16)
+            if not data:
+                if not _finished(self._decomp):
+                    raise IOError("Compressed data ended unexpectedly")
+                return b""
+            out = self._decomp.decompress(data)
+            while getattr(self._decomp, "eof", False):
+                rest = self._decomp.unused_data
+                if not rest:
+                    break
+                self._decomp = self._factory()
+                out += self._decomp.decompress(rest)
+            if out:
+                return out
+
+    def close(self):
+        pass
+
+
+def _finished(decomp):
+    """Returns whether decomp has seen the end of its stream"""
+    eof = getattr(decomp, "eof", None)
+    if eof is not None:
+        return eof
+    # The decompressobj of older zstandard versions doesn't tell, but
+    # refuses more input once it has seen the end.
+    try:
+        decomp.decompress(b"")
+    except zstandard.ZstdError:
+        return True
+    return False
+
+
+def _compressor(compression, level, mtime, fileobj):
+    """Returns an in-process compressor for compression
+
+    The returned object is a file object writing the compressed data
+    to fileobj, or None if the compression has to be done by an
+    external process.
+    """
+    if compression == "gzip":
+        return _GzipWriter(fileobj, level, mtime)
+    if compression == "bzip2":
+        return _CompressorFile(fileobj, bz2.BZ2Compressor(level or 9))
+    if compression in ("xz", "lzma") and lzma is not None:
+        fmt = lzma.FORMAT_XZ
+        if compression == "lzma":
+            fmt = lzma.FORMAT_ALONE
+        preset = level
+        if preset is None:
+            preset = 6
+        return _CompressorFile(fileobj,
+                               lzma.LZMACompressor(format=fmt, preset=preset))
+    return None
+
+
+class _GzipWriter(gzip.GzipFile):
+    """A GzipFile that never puts a file name in the header"""
+
+    def __init__(self, fileobj, level, mtime):
+        if level is None:
+            level = 9
+        gzip.GzipFile.__init__(self, filename="", mode="wb",
+                               compresslevel=level, fileobj=fileobj,
+                               mtime=mtime)
+
+
+def _compressor_command(compression, level, threads):
+    """Returns the command line to compress with
+
+    Returns None if the compression should rather be done in-process
+    (see _compressor).  External compressors are used when more than
+    one thread is asked for, or when there is no Python module for
+    the compression.
+    """
+    cmd = None
+    if threads is not None and threads != 1:
+        tool = _PARALLEL_COMPRESSORS.get(compression)
+        if tool is not None and which(tool):
+            cmd = [tool, "-c"]
+            if tool == "pigz":
+                cmd.append("-n")
+            if tool in ("pigz", "pbzip2"):
+                # pigz and pbzip2 have no "use all cores" setting
+                cmd.append("-p%d" % (threads or _cpu_count()))
+            elif tool == "zstd":
+                cmd.extend(["-q", "-T%d" % threads])
+            else:
+                cmd.append("-T%d" % threads)
+    if cmd is None:
+        if compression in ("gzip", "bzip2"):
+            return None
+        if compression in ("xz", "lzma") and lzma is not None:
+            return None
+        if compression == "zstd" and zstandard is not None:
+            return None
+        cmd = [compression, "-c"]
+        if compression == "zstd":
+            cmd.append("-q")
+    if level is not None:
+        cmd.append("-%d" % level)
+    return cmd
+
+
+def _cpu_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
 
 
 @contextmanager
@@ -46,8 +280,10 @@ def open_compressed_tarball(tarname, compression=None, fd=None):
     """Opens a compressed tarball in read-only mode as a TarFile
 
     This context manager transparently handles compressions unsupported
-    by TarFile by using external processes.  The following compressions
-    are supported "gzip", "bzip2", "xz" and "lzma".
+    by TarFile, in-process when the Python modules for them are
+    available and by using external processes otherwise.  The following
+    compressions are supported "gzip", "bzip2", "xz", "lzma" and "zstd";
+    "none" reads an uncompressed tarball.
 
     As the decompression may be done by an external process, seeking is
     generally not supported.
@@ -62,78 +298,181 @@ def open_compressed_tarball(tarname, compression=None, fd=None):
 
     The optional parameter fd must be a file-like object opened for
     reading.  When given, the "content" of the tarball is read from fd
-    rather than the file denoted by tarname.  This is useful for cases
+    rather than the file denoted by tarname.  Only its read method is
+    required.  This is useful for cases
     where the tarball is embedded inside another file (e.g. like the
     control.tar.gz in a .deb file).
     """
 
     if compression is None:
         compression = _determine_compression(tarname)
-    if compression == "gzip" or compression == "bzip2":
+    if compression in ("gzip", "bzip2", "none"):
         if fd is None:
             tf = tarfile.open(tarname)
         else:
             m = "r|gz"
             if compression == "bzip2":
                 m = "r|bz2"
+            elif compression == "none":
+                m = "r|"
             tf = tarfile.open(name=tarname, mode=m, fileobj=fd)
         yield tf
         tf.close()
-    else:
-        infd = fd
-        if infd is None:
-            infd = open(tarname, "r")
-        decomp = subprocess.Popen([compression, '-d'], shell=False, stdin=infd,
-                                  stdout=subprocess.PIPE,
-                                  universal_newlines=False)
-        tobj = tarfile.open(name=tarname, mode="r|", fileobj=decomp.stdout)
-        if fd is None:
-            infd.close()  # We don't need to keep this handle open
+        return
+
+    factory = None
+    if compression in ("xz", "lzma") and lzma is not None:
+        factory = lzma.LZMADecompressor
+    elif compression == "zstd" and zstandard is not None:
+        factory = zstandard.ZstdDecompressor().decompressobj
+    elif compression not in ("xz", "lzma", "zstd"):
+        raise ValueError("Unknown compression %s" % compression)
+
+    infd = fd
+    if infd is None:
+        infd = open(tarname, "rb")
+    if factory is not None:
+        tobj = tarfile.open(name=tarname, mode="r|",
+                            fileobj=_DecompressorFile(infd, factory))
+        try:
+            yield tobj
+            tobj.close()
+        finally:
+            if fd is None:
+                infd.close()
+        return
+
+    stdin = infd
+    if not _has_fileno(infd):
+        stdin = subprocess.PIPE
+    decomp = subprocess.Popen([compression, '-d', '-c'], shell=False,
+                              stdin=stdin, stdout=subprocess.PIPE,
+                              universal_newlines=False)
+    feeder = None
+    if stdin == subprocess.PIPE:
+        # fd is not backed by a file descriptor (e.g. a member of a .deb),
+        # so pump it into the decompressor from a thread.
+        feeder = threading.Thread(target=_feed_pipe,
+                                  args=(infd, decomp.stdin))
+        feeder.daemon = True
+        feeder.start()
+    tobj = tarfile.open(name=tarname, mode="r|", fileobj=decomp.stdout)
+    if fd is None:
+        infd.close()  # We don't need to keep this handle open
+    try:
         yield tobj
-        _close_pipeline(tobj, decomp.stdout, decomp, compression)
+    finally:
+        try:
+            _close_pipeline(tobj, decomp.stdout, decomp, compression,
+                            reading=True)
+        finally:
+            if feeder is not None:
+                feeder.join()
+
+
+def _has_fileno(fileobj):
+    try:
+        fileobj.fileno()
+    except (AttributeError, IOError, ValueError):
+        return False
+    return True
+
+
+def _feed_pipe(source, pipe):
+    try:
+        while True:
+            data = source.read(1 << 16)
+            if not data:
+                break
+            pipe.write(data)
+    except IOError:
+        # The reader went away early; it will report any problem itself.
+        pass
+    finally:
+        try:
+            pipe.close()
+        except IOError:
+            pass
 
 
 @contextmanager
-def _open_writeable_tarfile(tarbase, compression):
+def _open_writeable_tarfile(tarbase, compression, mtime=None, level=None,
+                            threads=None):
     """Opens an open TarFile for the given compression
 
     This opens a writable TarFile and compresses it with the specified
     compression.  The compression may be done by a pipeline and thus
     the TarFile may not be seekable.
 
-    Supported compressions are "gzip", "bzip2", "xz" and "lzma".
+    Supported compressions are "gzip", "bzip2", "xz", "lzma" and
+    "zstd".  If mtime is given, it is used as the timestamp in the gzip
+    header (which otherwise is the current time).
+
+    level is the compression level (compressor default if None).
+    threads is the number of compressor threads to use; None or 1
+    compresses in-process where possible, 0 means one per core.  More
+    than one thread needs the multi-threaded compressors (pigz, pbzip2,
+    xz or zstd) to be installed; without them the compression quietly
+    stays single-threaded.
     """
 
-    if compression == 'gzip' or compression == 'bzip2':
-        ext = "gz"
-        if compression == 'bzip2':
-            ext = "bz2"
-        m = "w:%s" % ext
-        tarball = "%s.%s" % (tarbase, ext)
-        tobj = tarfile.open(name=tarball, mode=m)
-        yield tobj
-        tobj.close()
+    ext = EXTENSIONS.get(compression)
+    if ext is None:
+        raise ValueError("Unknown compression %s" % compression)
+    tarball = "%s.%s" % (tarbase, ext)
+
+    cmd = _compressor_command(compression, level, threads)
+    if cmd is None and compression == "zstd":
+        # zstandard counts the other way round: 0 is no worker threads,
+        # -1 one per core.
+        zthreads = {None: 0, 1: 0, 0: -1}.get(threads, threads)
+        cctx = zstandard.ZstdCompressor(level=level or 3, threads=zthreads)
+        with open(tarball, "wb") as out:
+            comp = _CompressorFile(out, cctx.compressobj())
+            tobj = tarfile.open(name=tarball, mode="w|", fileobj=comp)
+            yield tobj
+            tobj.close()
+            comp.close()
         return
 
-    if compression != "xz" and compression != "lzma":
-        raise ValueError("Unknown compression %s" % compression)
+    if cmd is None:
+        with open(tarball, "wb") as out:
+            comp = _compressor(compression, level, mtime, out)
+            tobj = tarfile.open(name=tarball, mode="w|", fileobj=comp)
+            yield tobj
+            tobj.close()
+            comp.close()
+        return
 
-    m = "w|"
-    # assume compression == ext == command - holds for xz and lzma :>
-    # also assume the compressor takes no arguments and writes to stdout
-    tarball = "%s.%s" % (tarbase, compression)
-    out = open(tarball, "w")
-    compp = subprocess.Popen([compression], shell=False, stdin=subprocess.PIPE,
+    out = open(tarball, "wb")
+    compp = subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE,
                              stdout=out, universal_newlines=False)
     out.close()  # We don't need to keep this handle open
-    tobj = tarfile.open(name=tarball, mode=m, fileobj=compp.stdin)
+    tobj = tarfile.open(name=tarball, mode="w|", fileobj=compp.stdin)
     yield tobj
-    _close_pipeline(tobj, compp.stdin, compp, compression)
+    _close_pipeline(tobj, compp.stdin, compp, cmd[0])
+
 
+def _close_pipeline(tobj, procfd, proc, compression, reading=False):
+    """Close a TarFile and the process (de)compressing it
 
-def _close_pipeline(tobj, procfd, proc, compression):
+    If reading is True, procfd is the output of a decompressor.  When the
+    TarFile was not read to the end (e.g. because the caller already found
+    what it needed), the decompressor is stopped rather than reported as
+    failing.
+    """
     try:
         tobj.close()
+        # What's left after the end of archive marker is at most the
+        # padding to a full record; anything more means we stopped early.
+        if reading and len(procfd.read(tarfile.RECORDSIZE + 1)) > \
+                tarfile.RECORDSIZE:
+            # The decompressor may be blocked writing to us, or die of
+            # SIGPIPE.  Either way, that's not an error.
+            procfd.close()
+            proc.terminate()
+            proc.wait()
+            return
         procfd.close()
         proc.wait()
         if proc.returncode != 0:
@@ -162,4 +501,8 @@ def _determine_compression(filename):
         return "bzip2"
     if ext == "xz" or ext == "lzma":
         return ext
+    if ext == "zst":
+        return "zstd"
+    if ext == "tar":
+        return "none"
     raise ValueError("Cannot guess compression for %s" % filename)
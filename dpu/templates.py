@@ -5,14 +5,160 @@ This module contains Template classes to aid with rendering out model files
 into a test source directory.
 """
 
-from dpu.utils import rsync, tmpdir, dir_walk, rm, abspath, rmdir
+from dpu.utils import (rm, abspath, rmdir, mkdir, copy_file, clone_file,
+                       hash_tree)
 from dpu.tarball import make_orig_tarball
-from jinja2 import Template
+from jinja2 import Environment, PrefixLoader, FileSystemLoader
+from jinja2 import FileSystemBytecodeCache
+import os
 import os.path
 import sys
+import stat
+import errno
+import hashlib
+import tempfile
 
 _templates = sys.modules[__name__]
 
+# All Jinja templates are loaded through this one Environment, so that every
+# .tpl file is only parsed and compiled once per process. Each template
+# directory gets its own prefix in the loader.
+_loaders = {}
+_environment = Environment(loader=PrefixLoader(_loaders), cache_size=-1)
+
+
+def _template_prefix(path):
+    """
+    Get the loader prefix for the template directory `path', registering
+    the directory with the shared Environment if needed.
+    """
+    prefix = hashlib.sha1(path).hexdigest()[:16]
+    if prefix not in _loaders:
+        _loaders[prefix] = FileSystemLoader(path)
+    return prefix
+
+
+def set_bytecode_cache(path):
+    """
+    Keep compiled Jinja templates in the directory `path', so they are
+    compiled once across runs rather than once per process. Passing None
+    turns this off again.
+    """
+    cache = None
+    if path is not None:
+        try:
+            mkdir(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        cache = FileSystemBytecodeCache(path)
+    _environment.bytecode_cache = cache
+
+
+class _RenderPlan(object):
+    """
+    A _RenderPlan works out, for a stack of templates, which layer provides
+    each path of the output, and which of them need to go through Jinja.
+    Once all layers are in, every path is written out exactly once.
+    """
+
+    DIR = "dir"
+    SYMLINK = "symlink"
+    FILE = "file"
+    CLONE = "clone"
+    JINJA = "jinja"
+
+    def __init__(self):
+        self._plan = {}
+        self._dirs = set()
+
+    def _drop_tree(self, path):
+        """
+        Forget about everything below `path', a directory that is about to
+        be shadowed by something else.
+        """
+        prefix = path + "/"
+        for entry in [x for x in self._plan if x.startswith(prefix)]:
+            del self._plan[entry]
+            self._dirs.discard(entry)
+
+    def add(self, template):
+        """
+        Lay the template `template' over what is planned so far.
+        """
+        for path, kind, source, st in template._entries():
+            if kind == self.DIR:
+                self._dirs.add(path)
+            elif path in self._dirs:
+                self._drop_tree(path)
+                self._dirs.discard(path)
+            self._plan[path] = (kind, source, st, template)
+
+    def __len__(self):
+        return len(self._plan)
+
+    def entries(self):
+        """
+        Get the plan as a list of (path, kind, source, stat, template)
+        tuples, where `template' is the layer providing the path.
+        """
+        return [(x,) + self._plan[x] for x in sorted(self._plan)]
+
+    def materialize(self, dest, skip=()):
+        """
+        Write the planned tree out to `dest', on top of whatever is there.
+        Entries of a kind listed in `skip' are left out.
+        """
+        if not os.path.isdir(dest):
+            mkdir(dest)
+        # Sorting puts every directory before anything inside of it.
+        for path in sorted(self._plan):
+            kind, source, st, template = self._plan[path]
+            if kind in skip:
+                continue
+            target = os.path.join(dest, path)
+            if kind == self.DIR:
+                # A symlink (even to a directory) left by an earlier run
+                # goes, lest this layer be written through it.
+                if os.path.islink(target) or (os.path.lexists(target) and
+                                              not os.path.isdir(target)):
+                    rm(target)
+                if not os.path.isdir(target):
+                    os.mkdir(target)
+                os.chmod(target, stat.S_IMODE(st.st_mode))
+                continue
+
+            if os.path.isdir(target) and not os.path.islink(target):
+                rmdir(target)
+            if kind == self.SYMLINK:
+                if os.path.lexists(target):
+                    rm(target)
+                os.symlink(os.readlink(source), target)
+            elif kind == self.FILE:
+                copy_file(source, target, st=st)
+            elif kind == self.CLONE:
+                template._clone_file(source, target, st)
+            else:
+                template._render_file(source, target)
+        self._plan = {}
+        self._dirs = set()
+
+
+def _render_jinja(root, source, output, context):
+    """
+    Render the .tpl file `source' of the template directory `root' to
+    `output', with the context `context'.
+    """
+    prefix = _template_prefix(root)
+    name = os.path.relpath(source, root)
+    tobj = _environment.get_template("%s/%s" % (prefix, name))
+    # Always write a fresh file, don't inherit the mode of whatever was there
+    # before.
+    if os.path.lexists(output):
+        rm(output)
+    with open(output, 'w') as obj:
+        obj.write(tobj.render(**context))
+
 
 class PlainTemplate(object):
     """
@@ -21,6 +167,10 @@ class PlainTemplate(object):
     class there is.
     """
 
+    # Barriers are templates that act on the result of everything before
+    # them, so the TemplateManager can't merge layers across them.
+    barrier = False
+
     def __init__(self, where):
         """
         `where' is a path (abs or rel) to the Template directory, to be
@@ -28,13 +178,32 @@ class PlainTemplate(object):
         """
         self._template_path = abspath(where)
 
+    def _entries(self):
+        """
+        Yield a (path, kind, source, stat) tuple for everything in the
+        template directory, with `path' relative to the template root.
+        """
+        root_path = self._template_path
+        for root, dirs, files in os.walk(root_path):
+            for name in dirs + files:
+                source = os.path.join(root, name)
+                st = os.lstat(source)
+                if stat.S_ISLNK(st.st_mode):
+                    kind = _RenderPlan.SYMLINK
+                elif stat.S_ISDIR(st.st_mode):
+                    kind = _RenderPlan.DIR
+                else:
+                    kind = _RenderPlan.FILE
+                yield (os.path.relpath(source, root_path), kind, source, st)
+
     def render(self, dest):
         """
         `dest' is a path (abs or rel) to the output directory, or where to
         write the model files to.
         """
-        dest = abspath(dest)
-        rsync(self._template_path, dest)
+        plan = _RenderPlan()
+        plan.add(self)
+        plan.materialize(abspath(dest))
 
 
 class JinjaTemplate(PlainTemplate):
@@ -47,27 +216,31 @@ class JinjaTemplate(PlainTemplate):
         PlainTemplate.__init__(self, where)
         self.set_context(context)
 
-    def render(self, dest):
+    def _entries(self):
         """
-        `dest' is a path (abs or rel) to the output directory, or where to
-        write the model files to. Be extra-sure to call setContext on this
-        particular class, it's important to render out the Jinja context
-        correctly.
+        Like PlainTemplate._entries, but .tpl files are planned to be
+        rendered to the name without the extention. They come last, so they
+        win over a plain file of the same name.
         """
-        dest = abspath(dest)
-
         if self.context is None:
             raise ValueError("No context set for this JinjaTemplate")
 
-        with tmpdir() as tmp:
-            PlainTemplate.render(self, tmp)
-            for template in dir_walk(tmp, xtn=".tpl"):
-                with open(template, 'r') as fd:
-                    tobj = Template(fd.read())
-                    with open(template.rsplit(".", 1)[0], 'w') as obj:
-                        obj.write(tobj.render(**self.context))
-                rm(template)
-            rsync(tmp, dest)
+        templates = []
+        for entry in PlainTemplate._entries(self):
+            path, kind, source, st = entry
+            if kind == _RenderPlan.FILE and path.endswith(".tpl"):
+                templates.append((path.rsplit(".", 1)[0], _RenderPlan.JINJA,
+                                  source, st))
+            else:
+                yield entry
+        for entry in templates:
+            yield entry
+
+    def _render_file(self, source, output):
+        """
+        Render the .tpl file `source' of this template to `output'.
+        """
+        _render_jinja(self._template_path, source, output, self.context)
 
     def set_context(self, context):
         """
@@ -77,6 +250,109 @@ class JinjaTemplate(PlainTemplate):
         self.context = context
 
 
+class SnapshotTemplate(PlainTemplate):
+    """
+    A SnapshotTemplate stands in for a run of shared templates, whose plain
+    files have been rendered once into a snapshot (see SnapshotStore). Those
+    files are cloned out of the snapshot; only the Jinja templates of the
+    run are rendered again, with this template's context.
+    """
+
+    def __init__(self, entries, hardlink, context=None):
+        """
+        `entries' is the snapshot plan as built by the SnapshotStore,
+        `hardlink' whether we may fall back to hardlinks if the filesystem
+        can't do reflinks.
+        """
+        self._snapshot = entries
+        self._hardlink = hardlink
+        self._roots = dict((x[2], x[4]) for x in entries
+                           if x[1] == _RenderPlan.JINJA)
+        self.set_context(context)
+
+    def _entries(self):
+        for path, kind, source, st, _ in self._snapshot:
+            yield path, kind, source, st
+
+    def _clone_file(self, source, target, st):
+        clone_file(source, target, st=st, hardlink=self._hardlink)
+
+    def _render_file(self, source, output):
+        _render_jinja(self._roots[source], source, output, self.context)
+
+    def set_context(self, context):
+        """
+        This sets the context used to render the Jinja templates of the run.
+        """
+        self.context = context
+
+
+class SnapshotStore(object):
+    """
+    The SnapshotStore keeps, for every distinct run of shared templates,
+    the plain files of that run rendered once into a read-only snapshot
+    directory. Tests get a clone of the snapshot (see SnapshotTemplate)
+    instead of rendering the run again.
+
+    The store is safe to share between worker processes; snapshots are
+    staged next to the store and renamed into place.
+    """
+
+    def __init__(self, root, hardlink=False):
+        """
+        `root' is the directory to keep the snapshots in. If `hardlink' is
+        true, clones fall back to hardlinks where reflinks are not
+        available; tools that modify files in place (rather than replacing
+        them) must not be run on the tree then.
+        """
+        self._root = abspath(root)
+        self._hardlink = hardlink
+        self._snapshots = {}
+
+    def _build(self, templates):
+        plan = _RenderPlan()
+        for template in templates:
+            plan.add(template)
+        planned = plan.entries()
+        key = hashlib.sha1("\0".join(
+            x._template_path for x in templates)).hexdigest()
+        snapdir = os.path.join(self._root, key)
+        if not os.path.exists(snapdir):
+            staging = tempfile.mkdtemp(prefix=".staging-", dir=self._root)
+            plan.materialize(os.path.join(staging, "tree"),
+                             skip=(_RenderPlan.JINJA,))
+            try:
+                os.rename(os.path.join(staging, "tree"), snapdir)
+            except OSError as e:
+                # Someone else was quicker; theirs is just as good.
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+            finally:
+                rmdir(staging)
+
+        entries = []
+        for path, kind, source, st, template in planned:
+            root = None
+            if kind == _RenderPlan.FILE:
+                kind = _RenderPlan.CLONE
+                source = os.path.join(snapdir, path)
+            elif kind == _RenderPlan.JINJA:
+                root = template._template_path
+            entries.append((path, kind, source, st, root))
+        return entries
+
+    def get(self, templates, context):
+        """
+        Get a SnapshotTemplate for the list of `templates', rendering their
+        Jinja templates with `context'.
+        """
+        key = tuple(x._template_path for x in templates)
+        if key not in self._snapshots:
+            self._snapshots[key] = self._build(templates)
+        return SnapshotTemplate(self._snapshots[key], self._hardlink,
+                                context=context)
+
+
 class UpstreamShim(PlainTemplate):
     """
     This "fake" Template is actually a hook into the Template rendering process
@@ -84,13 +360,21 @@ class UpstreamShim(PlainTemplate):
     stuff. This allows for non-native emulation.
     """
 
-    def __init__(self, pkgname, version):
+    barrier = True
+
+    def __init__(self, pkgname, version, mtime=None, cache=None):
         """
         OK, we're overloading this because we don't need a model directory.
+
+        If `mtime' is given, the tarball is made reproducibly with that
+        timestamp (see make_orig_tarball), and kept in the ArtifactCache
+        `cache' (if given), keyed by the content of the upstream tree.
         """
         self.compression = "gzip"
         self.pkgname = pkgname
         self.version = version
+        self.mtime = mtime
+        self.cache = cache
 
     def set_compression(self, compression):
         self.compression = compression
@@ -102,9 +386,21 @@ class UpstreamShim(PlainTemplate):
         ready for taring up.
         """
         dest = abspath("%s/../" % (dest))
-        make_orig_tarball(dest, self.pkgname, self.version,
-                          compression=self.compression,
-                          outputdir=dest)
+        cache = self.cache
+        if cache is None or self.mtime is None:
+            make_orig_tarball(dest, self.pkgname, self.version,
+                              compression=self.compression,
+                              outputdir=dest, mtime=self.mtime)
+            return
+
+        upstream = os.path.join(dest, "%s-%s" % (self.pkgname, self.version))
+        key = cache.key(hash_tree(upstream), self.pkgname, self.version,
+                        self.compression, str(self.mtime))
+        if cache.restore(key, dest) is None:
+            tarball = make_orig_tarball(dest, self.pkgname, self.version,
+                                        compression=self.compression,
+                                        outputdir=dest, mtime=self.mtime)
+            cache.store(key, [tarball])
 
 
 class DebianShim(PlainTemplate):
@@ -113,6 +409,8 @@ class DebianShim(PlainTemplate):
     directories out, before laying down some sanity.
     """
 
+    barrier = True
+
     def __init__(self):
         """
         OK, we're overloading this because we don't need a model directory.
@@ -170,6 +468,19 @@ class TemplateManager(object):
     def render(self, dest):
         """
         Render out the queue to the directory `dest`.
+
+        Consecutive templates are merged into a single plan first, so a file
+        shadowed by a later template is never written. Barrier templates
+        (the shims, or anything that is not a PlainTemplate) are rendered
+        on their own, in order, between those merged runs.
         """
+        dest = abspath(dest)
+        plan = _RenderPlan()
         for element in self._chain:
-            element.render(dest)
+            if getattr(element, "barrier", True):
+                if len(plan):
+                    plan.materialize(dest)
+                element.render(dest)
+            else:
+                plan.add(element)
+        plan.materialize(dest)
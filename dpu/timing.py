@@ -0,0 +1,158 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module times the stages a test goes through (rendering, building,
+checking, the hooks, ...), and writes the timings out as JSON lines or as a
+Chrome trace (which Perfetto reads as well).
+
+A stage records:
+
+ - "wall": the wall clock time spent in it
+ - "cpu": the CPU time (user and system) of this process during it
+ - "child_cpu": the CPU time of the child processes that ended during it
+ - "maxrss": the largest peak RSS (in KiB) of the commands run with
+   dpu.utils.run_command (or command_output) during it, from wait4
+"""
+
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+
+_local = threading.local()
+
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def note_child(usage):
+    """
+    Tell the stage currently being timed in this thread (if any) about a
+    child process that ended, and its resource usage `usage' (as returned by
+    os.wait4).
+    """
+    stage = getattr(_local, "stage", None)
+    if stage is not None:
+        stage["maxrss"] = max(stage["maxrss"], usage.ru_maxrss)
+
+
+class StageTimer(object):
+    """
+    A StageTimer collects the timings of the stages of one test, in the
+    order they were run, in `stages' (a list of dicts).
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the stage `name' for as long as the context lasts.
+        """
+        record = {"stage": name, "start": time.time(), "maxrss": 0}
+        outer = getattr(_local, "stage", None)
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _local.stage = record
+        try:
+            yield record
+        finally:
+            _local.stage = outer
+            record["wall"] = time.time() - record["start"]
+            record["cpu"] = _cpu(resource.getrusage(
+                resource.RUSAGE_SELF)) - _cpu(own)
+            record["child_cpu"] = _cpu(resource.getrusage(
+                resource.RUSAGE_CHILDREN)) - _cpu(children)
+            if outer is not None:
+                outer["maxrss"] = max(outer["maxrss"], record["maxrss"])
+            self.stages.append(record)
+
+
+def stage_records(results):
+    """
+    Yield a flat dict for every stage of every result in `results' (objects
+    with the test_id, worker and timings of dpu.runner.TestResult).
+    """
+    for result in results:
+        for stage in result.timings:
+            record = dict(stage)
+            record["test"] = result.test_id
+            record["worker"] = result.worker
+            yield record
+
+
+def stage_totals(results):
+    """
+    Sum up the timings of `results' by stage. Returns a dict of the stage
+    name to a dict with the "count", "wall", "cpu" and "child_cpu" totals,
+    and the largest "maxrss".
+    """
+    totals = {}
+    for record in stage_records(results):
+        total = totals.get(record["stage"])
+        if total is None:
+            total = {"count": 0, "wall": 0.0, "cpu": 0.0, "child_cpu": 0.0,
+                     "maxrss": 0}
+            totals[record["stage"]] = total
+        total["count"] += 1
+        for key in ("wall", "cpu", "child_cpu"):
+            total[key] += record[key]
+        total["maxrss"] = max(total["maxrss"], record["maxrss"])
+    return totals
+
+
+def write_json_lines(fd, results):
+    """
+    Write the timings of `results' to the file object `fd', a JSON object
+    per stage and line.
+    """
+    for record in stage_records(results):
+        fd.write(json.dumps(record, sort_keys=True))
+        fd.write("\n")
+
+
+def chrome_trace(results):
+    """
+    Get the timings of `results' in the Chrome trace event format. Every
+    worker is a thread, with a slice for every test and a slice for each of
+    its stages below that.
+    """
+    events = []
+    workers = set()
+
+    def usecs(seconds):
+        return int(round(seconds * 1000000))
+
+    for result in results:
+        if result.worker not in workers:
+            workers.add(result.worker)
+            events.append({"name": "thread_name", "ph": "M", "pid": 0,
+                           "tid": result.worker,
+                           "args": {"name": "worker %s" % (result.worker)}})
+        events.append({"name": result.test_id, "cat": "test", "ph": "X",
+                       "pid": 0, "tid": result.worker,
+                       "ts": usecs(result.started),
+                       "dur": usecs(result.ended - result.started),
+                       "args": {"status": result.status}})
+        for stage in result.timings:
+            events.append({"name": stage["stage"], "cat": "stage",
+                           "ph": "X", "pid": 0, "tid": result.worker,
+                           "ts": usecs(stage["start"]),
+                           "dur": usecs(stage["wall"]),
+                           "args": {"test": result.test_id,
+                                    "cpu": stage["cpu"],
+                                    "child_cpu": stage["child_cpu"],
+                                    "maxrss": stage["maxrss"]}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace(fd, results):
+    """
+    Write the timings of `results' to the file object `fd' as a Chrome
+    trace (see chrome_trace).
+    """
+    json.dump(chrome_trace(results), fd)
@@ -2,9 +2,16 @@
 # license.
 
 import os
+import sys
 import json
+import stat
+import fcntl
+import ctypes
 import errno
 import shutil
+import fnmatch
+import difflib
+import hashlib
 import os.path
 import tempfile
 import subprocess
@@ -14,12 +21,37 @@ from contextlib import contextmanager
 from dpu import (ENTRY_TYPE_DIR,
                  ENTRY_TYPE_FILE,
                  ENTRY_TYPE_SYMLINK)
+from dpu.timing import note_child
 
 flattern = chain.from_iterable
 
 
 def load_config(fpath):
-    return json.load(open(fpath, 'r'))
+    with open(fpath, 'r') as fd:
+        return json.load(fd)
+
+
+def save_config(fpath, data):
+    """
+    Write `data' to the JSON file `fpath' (creating its directory if
+    needed). The file is replaced atomically, so concurrent readers never
+    see half of it.
+    """
+    dirname = os.path.dirname(os.path.abspath(fpath))
+    try:
+        mkdir(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp = tempfile.mkstemp(prefix=".%s-" % (os.path.basename(fpath)),
+                               dir=dirname)
+    try:
+        with os.fdopen(fd, "w") as out:
+            json.dump(data, out)
+        os.rename(tmp, fpath)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
 
 
 @contextmanager
@@ -33,8 +65,12 @@ def cd(path):
 
 
 @contextmanager
-def tmpdir():
-    path = tempfile.mkdtemp()
+def tmpdir(root=None):
+    """
+    Create a temporary directory (below `root', if given, or the default
+    temporary directory otherwise), and remove it again afterwards.
+    """
+    path = tempfile.mkdtemp(dir=root)
     try:
         yield path
     finally:
@@ -42,6 +78,14 @@ def tmpdir():
     rmdir(path)
 
 
+def free_space(path):
+    """
+    Return the number of bytes available to us on the filesystem of `path'.
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
 def mkdir(folder, destroy_old=False):
     try:
         os.makedirs(folder)
@@ -92,11 +136,260 @@ def abspath(folder):
     return os.path.abspath(folder)
 
 
+def hash_file(path):
+    """
+    Return the hex sha1 digest of the content of the file `path'.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(65536), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_tree(path):
+    """
+    Return the hex sha1 digest of the directory tree `path'. The names, types,
+    permissions, symlink targets and file content of every entry take part,
+    but timestamps and ownership do not.
+    """
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            fpath = os.path.join(root, name)
+            st = os.lstat(fpath)
+            rel = os.path.relpath(fpath, path)
+            if stat.S_ISLNK(st.st_mode):
+                data = os.readlink(fpath)
+            elif stat.S_ISREG(st.st_mode):
+                data = hash_file(fpath)
+            else:
+                data = ""
+            h.update("%s\0%o\0%s\n" % (rel, st.st_mode, data))
+    return h.hexdigest()
+
+
+def _libc_call(name, *argtypes):
+    """
+    Get the C library function `name' (taking `argtypes'), wrapped to raise
+    OSError on failure like the os module does, or None if there's no such
+    function.
+    """
+    try:
+        func = getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = argtypes
+    func.restype = ctypes.c_ssize_t
+
+    def call(*args):
+        n = func(*args)
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+    return call
+
+
+_libc_copy_file_range = _libc_call("copy_file_range", ctypes.c_int,
+                                   ctypes.c_void_p, ctypes.c_int,
+                                   ctypes.c_void_p, ctypes.c_size_t,
+                                   ctypes.c_uint)
+_libc_sendfile = _libc_call("sendfile", ctypes.c_int, ctypes.c_int,
+                            ctypes.c_void_p, ctypes.c_size_t)
+
+
+def _copy_file_range(infd, outfd, count):
+    return _libc_copy_file_range(infd, None, outfd, None, count, 0)
+
+
+def _sendfile(infd, outfd, count):
+    return _libc_sendfile(outfd, infd, None, count)
+
+
+# Ways of copying in the kernel, best first. Both go from the current
+# offsets of the files, and move them along.
+_FAST_COPIES = []
+if _libc_copy_file_range is not None:
+    _FAST_COPIES.append(_copy_file_range)
+if _libc_sendfile is not None:
+    _FAST_COPIES.append(_sendfile)
+
+
+def _copy_fd(infd, outfd, size):
+    """
+    Copy `size' bytes from `infd' to `outfd', letting the kernel do the work
+    where it knows how. Whatever it leaves (say, if the file shrank or grew
+    meanwhile) is copied with read and write.
+    """
+    copied = 0
+    for call in _FAST_COPIES:
+        try:
+            while copied < size:
+                n = call(infd, outfd, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            break
+        except OSError as e:
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS,
+                                         errno.EINVAL, errno.EOPNOTSUPP,
+                                         errno.EBADF):
+                raise
+    while True:
+        block = os.read(infd, 1 << 16)
+        if not block:
+            break
+        os.write(outfd, block)
+
+
+def copy_file(source, target, st=None):
+    """
+    Copy the regular file `source' to `target', keeping its permissions and
+    timestamps. An existing `target' is unlinked rather than written
+    through, so hardlinks to it are left alone.
+    """
+    if st is None:
+        st = os.stat(source)
+    if os.path.lexists(target):
+        os.unlink(target)
+    with open(source, 'rb') as src:
+        with open(target, 'wb') as dst:
+            _copy_fd(src.fileno(), dst.fileno(), st.st_size)
+    os.chmod(target, stat.S_IMODE(st.st_mode))
+    os.utime(target, (st.st_atime, st.st_mtime))
+
+
+# From linux/fs.h; clones the extents of one file into another.
+FICLONE = 0x40049409
+
+
+def clone_file(source, target, st=None, hardlink=False):
+    """
+    Make `target' a copy-on-write clone of the regular file `source'. This
+    is a reflink where the filesystem supports it. Otherwise, if `hardlink'
+    is true, `target' becomes a hardlink to `source', or else a plain copy.
+    """
+    if st is None:
+        st = os.stat(source)
+    if os.path.lexists(target):
+        os.unlink(target)
+    try:
+        with open(source, 'rb') as src:
+            with open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        os.chmod(target, stat.S_IMODE(st.st_mode))
+        os.utime(target, (st.st_atime, st.st_mtime))
+        return
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                           errno.ENOTTY, errno.ENOSYS):
+            raise
+        os.unlink(target)
+    if hardlink:
+        try:
+            os.link(source, target)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    copy_file(source, target, st=st)
+
+
+def _same_file(source, sst, target, tst):
+    """
+    Check if the regular files `source' and `target' have the same content.
+    """
+    if sst.st_size != tst.st_size:
+        return False
+    with open(source, 'rb') as a:
+        with open(target, 'rb') as b:
+            while True:
+                ablock = a.read(65536)
+                if ablock != b.read(65536):
+                    return False
+                if not ablock:
+                    return True
+
+
 def rsync(source, target, excludes=None):
-    cmd = ['rsync', '-arpc', source + "/", target + "/"]
-    if excludes:
-        cmd.extend("--exclude=%s" % x for x in excludes)
-    subprocess.check_call(cmd, shell=False)
+    """
+    Make the tree `target' a copy of the tree `source', much like
+    "rsync -a" would (but in-process): directories, symlinks, permissions
+    and file timestamps are carried over, and files which already have the
+    right content and mode are left as they are. Existing entries in
+    `target' that are not in `source' are kept.
+
+    `excludes' is a list of shell patterns; any entry whose name matches one
+    of them is skipped.
+    """
+    excludes = excludes or []
+
+    def excluded(name):
+        return any(fnmatch.fnmatch(name, x) for x in excludes)
+
+    if not os.path.isdir(target):
+        mkdir(target)
+    for root, dirs, files in os.walk(source):
+        troot = os.path.join(target, os.path.relpath(root, source))
+        dirs[:] = [x for x in dirs if not excluded(x)]
+        for name in dirs + [x for x in files if not excluded(x)]:
+            spath = os.path.join(root, name)
+            tpath = os.path.join(troot, name)
+            sst = os.lstat(spath)
+            try:
+                tst = os.lstat(tpath)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                tst = None
+
+            if tst is not None and (stat.S_IFMT(sst.st_mode) !=
+                                    stat.S_IFMT(tst.st_mode)):
+                if stat.S_ISDIR(tst.st_mode):
+                    rmdir(tpath)
+                else:
+                    os.unlink(tpath)
+                tst = None
+
+            if stat.S_ISDIR(sst.st_mode):
+                if tst is None:
+                    os.mkdir(tpath)
+                os.chmod(tpath, stat.S_IMODE(sst.st_mode))
+            elif stat.S_ISLNK(sst.st_mode):
+                link_target = os.readlink(spath)
+                if tst is not None:
+                    if os.readlink(tpath) == link_target:
+                        continue
+                    os.unlink(tpath)
+                os.symlink(link_target, tpath)
+            elif (tst is not None and sst.st_mode == tst.st_mode and
+                    _same_file(spath, sst, tpath, tst)):
+                continue
+            else:
+                copy_file(spath, tpath, st=sst)
+
+
+def _wait(proc):
+    """
+    Wait for the subprocess.Popen `proc' to end, like proc.wait() would, but
+    also tell the stage being timed (see dpu.timing) what resources it used.
+    Returns the exit code.
+    """
+    while True:
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    note_child(usage)
+    return proc.returncode
 
 
 def run_command(cmd, output=False):
@@ -104,15 +397,60 @@ def run_command(cmd, output=False):
     if not output:
         out = open("/dev/null", "w")
     try:
-        subprocess.check_call(cmd,
-                              shell=False,
-                              stderr=out,
-                              stdout=out)
+        proc = subprocess.Popen(cmd,
+                                shell=False,
+                                stderr=out,
+                                stdout=out)
+        if _wait(proc) != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
     finally:
         if out is not None:
             out.close()
 
 
+def command_output(cmd):
+    """
+    Run `cmd' and return what it wrote to stdout.
+    """
+    with open("/dev/null", "w") as null:
+        proc = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE,
+                                stderr=null)
+        with proc.stdout:
+            output = proc.stdout.read()
+        if _wait(proc) != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                                output=output)
+    return output
+
+
+def which(program):
+    """
+    Return the path to `program' if it's found on $PATH, None otherwise.
+    """
+    for folder in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        fpath = os.path.join(folder, program)
+        if os.path.isfile(fpath) and os.access(fpath, os.X_OK):
+            return fpath
+    return None
+
+
+def changes_files(fpath):
+    """
+    Return the names of the files listed in the Files field of the .changes
+    file `fpath'.
+    """
+    files = []
+    in_files = False
+    with open(fpath, 'r') as fd:
+        for line in fd:
+            if line[:1] in (" ", "\t"):
+                if in_files and line.strip():
+                    files.append(line.split()[-1])
+                continue
+            in_files = line.split(":", 1)[0] == "Files"
+    return files
+
+
 def run_builder(*args):
     run_command(args)
 
@@ -121,31 +459,70 @@ def run_checker(*args):
     run_command(args)
 
 
+def same_content(from_file, to_file):
+    """
+    Return True if the files `from_file' and `to_file' have the same
+    content. Files of different sizes are not even read.
+    """
+    return _same_file(from_file, os.stat(from_file), to_file,
+                      os.stat(to_file))
+
+
+def _unified_diff(from_data, to_data, from_label, to_label):
+    """
+    Yield the lines of the unified diff (like "diff -u") of the strings
+    `from_data' and `to_data'.
+    """
+    if "\0" in from_data or "\0" in to_data:
+        yield "Binary files %s and %s differ\n" % (from_label, to_label)
+        return
+    lines = difflib.unified_diff(from_data.splitlines(True),
+                                 to_data.splitlines(True),
+                                 from_label, to_label)
+    for line in lines:
+        if line.endswith("\n"):
+            yield line
+        else:
+            yield line + "\n"
+            yield "\\ No newline at end of file\n"
+
+
+def _write_diff(from_data, to_data, from_label, to_label, output_fd):
+    if output_fd is None:
+        output_fd = sys.stdout
+    for line in _unified_diff(from_data, to_data, from_label, to_label):
+        output_fd.write(line)
+    output_fd.flush()
+
+
 def diff(from_file, to_file, output_fd=None):
-    cmd = ['diff', '-u',
-           '--label=%s' % from_file,
-           from_file,
-           '--label=%s' % to_file,
-           to_file]
-    proc = subprocess.Popen(cmd, stdout=output_fd)
-    ret = proc.wait()
-    return ret == 0
+    """
+    Return True if `from_file' and `to_file' have the same content.  If
+    they don't, a unified diff of them is written to `output_fd' (stdout
+    if None).
+    """
+    if same_content(from_file, to_file):
+        return True
+    with open(from_file, "rb") as fd:
+        from_data = fd.read()
+    with open(to_file, "rb") as fd:
+        to_data = fd.read()
+    _write_diff(from_data, to_data, from_file, to_file, output_fd)
+    return False
 
 
 def diff_against_string(from_file, to_string, output_fd=None):
-    cmd = ['diff', '-u',
-           '--label=%s' % from_file,
-           from_file,
-           '--label=%s' % "-",
-           "-"]
-    proc = subprocess.Popen(cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=output_fd)
-    if to_string is not None:
-        proc.stdin.write(to_string)
-        proc.stdin.close()
-    ret = proc.wait()
-    return ret == 0
+    """
+    Like diff, but compares `from_file' to the string `to_string'.
+    """
+    if to_string is None:
+        to_string = ""
+    with open(from_file, "rb") as fd:
+        from_data = fd.read()
+    if from_data == to_string:
+        return True
+    _write_diff(from_data, to_string, from_file, "-", output_fd)
+    return False
 
 
 def unix_perm(p):
@@ -2,12 +2,13 @@
 
 import os
 
-from dpu.tarball import make_orig_tarball, open_compressed_tarball
+from dpu.tarball import (make_orig_tarball, open_compressed_tarball,
+                         EXTENSIONS)
 from dpu.utils import tmpdir, mkdir, abspath, cd
 
 
 def make_and_check_tarball(testname, rundir, upname, upversion, compression,
-                           visitor, visit_open=True):
+                           visitor, visit_open=True, **kwargs):
     """Create, check and clean up a tarball (test utility)
 
     Utility for setting up a dir, compile a tarball from a resource path,
@@ -17,19 +18,15 @@ def make_and_check_tarball(testname, rundir, upname, upversion, compression,
     compression is also used for this purpose, so multiple tests can
     share the same "testname" as long as the compression differs.
 
-    rundir, upname, upversion and compression are passed (as is) to
-    make_orig_tarball.
+    rundir, upname, upversion, compression and any further keyword
+    arguments are passed (as is) to make_orig_tarball.
 
     The tarball passed to visitor may not be seekable and should be
     checked inorder.
     """
 
     testdir = "%s-%s" % (testname, compression)
-    xtn = compression
-    if xtn == "gzip":
-        xtn = "gz"
-    elif xtn == "bzip2":
-        xtn = "bz2"
+    xtn = EXTENSIONS[compression]
 
     rundir = abspath(rundir)
 
@@ -38,7 +35,8 @@ def make_and_check_tarball(testname, rundir, upname, upversion, compression,
             mkdir(testdir)
 
             make_orig_tarball(rundir, upname, upversion,
-                              compression=compression, outputdir=testdir)
+                              compression=compression, outputdir=testdir,
+                              **kwargs)
             tarname = "%s_%s.orig.tar.%s" % (upname, upversion, xtn)
             path = os.path.join(testdir, tarname)
             if visit_open:
@@ -0,0 +1,63 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module tests the artifact cache.
+"""
+
+import os
+import time
+
+from dpu.cache import ArtifactCache
+from dpu.utils import tmpdir, mkdir
+
+
+def write(path, content):
+    with open(path, 'w') as fd:
+        fd.write(content)
+
+
+def test_cache_roundtrip():
+    """
+    Make sure what we store comes back out, and misses are misses.
+    """
+    with tmpdir() as tmp:
+        cache = ArtifactCache(os.path.join(tmp, "cache"))
+        src = os.path.join(tmp, "src")
+        dest = os.path.join(tmp, "dest")
+        mkdir(src)
+        mkdir(dest)
+        write(os.path.join(src, "foo.deb"), "foo")
+        write(os.path.join(src, "foo.changes"), "changes")
+
+        key = cache.key("tree", "builder")
+        assert key != cache.key("tree", "other-builder")
+        assert cache.restore(key, dest) is None
+
+        cache.store(key, [os.path.join(src, x) for x in os.listdir(src)])
+        names = cache.restore(key, dest)
+        assert sorted(names) == ["foo.changes", "foo.deb"]
+        assert open(os.path.join(dest, "foo.deb")).read() == "foo"
+
+
+def test_cache_eviction():
+    """
+    Make sure the least recently used entries go first.
+    """
+    with tmpdir() as tmp:
+        cache = ArtifactCache(os.path.join(tmp, "cache"), max_size=25)
+        dest = os.path.join(tmp, "dest")
+        mkdir(dest)
+        keys = []
+        for x in range(3):
+            fpath = os.path.join(tmp, "file%d" % (x))
+            write(fpath, "x" * 10)
+            key = cache.key(str(x))
+            keys.append(key)
+            cache.store(key, [fpath])
+            # Make sure the last-use times are distinguishable
+            atime = time.time() - 100 + x
+            os.utime(cache._entry(key), (atime, atime))
+
+        assert cache.size() <= 25
+        assert cache.restore(keys[0], dest) is None
+        assert cache.restore(keys[2], dest) is not None
@@ -0,0 +1,125 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module tests reading .deb files.
+"""
+
+import os
+import tarfile
+
+import dpu.tarball
+from dpu.deb import ar_members, open_deb_tarball
+from dpu.manifest import parse_manifest
+from dpu.tarball import _open_writeable_tarfile
+from dpu.utils import tmpdir, which
+from dpu.exceptions import EntryNotPresentAssertionError
+
+resources = "./tests/resources/"
+
+
+def _tar_filter(tarinfo):
+    if tarinfo.name.startswith("./"):
+        tarinfo.name = tarinfo.name[2:]
+    tarinfo.uname = tarinfo.gname = "root"
+    tarinfo.uid = tarinfo.gid = 0
+    # Don't depend on the umask of the checkout
+    if tarinfo.isdir() or tarinfo.name.endswith("/script"):
+        tarinfo.mode = 0755
+    elif tarinfo.isfile():
+        tarinfo.mode = 0644
+    return tarinfo
+
+
+def make_tarball(base, compression, root):
+    if compression == "none":
+        tarball = base + ".tar"
+        tobj = tarfile.open(tarball, "w")
+        tobj.add(root, arcname=".", filter=_tar_filter)
+        tobj.close()
+        return tarball
+    with _open_writeable_tarfile(base + ".tar", compression) as tobj:
+        tobj.add(root, arcname=".", filter=_tar_filter)
+        return tobj.name
+
+
+def make_deb(debpath, members):
+    with open(debpath, "wb") as deb:
+        deb.write("!<arch>\n")
+        for name, content in members:
+            deb.write("%-16s%-12d%-6d%-6d%-8o%-10d`\n" % (
+                name + "/", 0, 0, 0, 0100644, len(content)))
+            deb.write(content)
+            if len(content) % 2:
+                deb.write("\n")
+
+
+def make_package(tmp, compression, root):
+    control = make_tarball(os.path.join(tmp, "control"), "gzip",
+                           os.path.join(resources, "manifest-tarball"))
+    data = make_tarball(os.path.join(tmp, "data"), compression, root)
+    members = [("debian-binary", "2.0\n")]
+    for path in (control, data):
+        with open(path, "rb") as fd:
+            members.append((os.path.basename(path), fd.read()))
+    debpath = os.path.join(tmp, "foo.deb")
+    make_deb(debpath, members)
+    return debpath
+
+
+def test_ar_members():
+    with tmpdir() as tmp:
+        debpath = os.path.join(tmp, "foo.deb")
+        make_deb(debpath, [("debian-binary", "2.0\n"), ("odd", "abc"),
+                           ("last", "xy")])
+        with open(debpath, "rb") as fd:
+            seen = []
+            for member in ar_members(fd):
+                # Leave "odd" unread, to test skipping past it.
+                if member.name != "odd":
+                    seen.append((member.name, member.read()))
+        assert seen == [("debian-binary", "2.0\n"), ("last", "xy")]
+
+
+def test_check_deb():
+    """
+    Check a manifest against the data.tar of .debs with every compression,
+    also when the package isn't read from a real file.
+    """
+    man = parse_manifest(os.path.join(resources, "manifest-tarball",
+                                      "manifest"))
+    root = os.path.join(resources, "manifest-tarball", "root")
+    compressions = ["none", "gzip", "bzip2", "xz"]
+    if dpu.tarball.zstandard is not None or which("zstd"):
+        compressions.append("zstd")
+    for compression in compressions:
+        with tmpdir() as tmp:
+            debpath = make_package(tmp, compression, root)
+            man.check_deb(debpath)
+            with open(debpath, "rb") as fd:
+                with open_deb_tarball(debpath, "control", fd=fd) as tar:
+                    assert "manifest" in [x.name for x in tar]
+
+
+def test_check_deb_pipe():
+    """
+    Decompressing through an external process has to work too, although
+    members of a .deb have no file descriptor.
+    """
+    saved = dpu.tarball.lzma
+    dpu.tarball.lzma = None
+    try:
+        man = parse_manifest(os.path.join(resources, "manifest-tarball",
+                                          "manifest"))
+        with tmpdir() as tmp:
+            root = os.path.join(tmp, "root")
+            os.makedirs(os.path.join(root, "usr/random"))
+            with open(os.path.join(root, "usr/random/place"), "w") as fd:
+                fd.write("Not supposed to be here!")
+            debpath = make_package(tmp, "xz", root)
+            try:
+                man.check_deb(debpath)
+                raise AssertionError("Unexpected file was not noticed")
+            except EntryNotPresentAssertionError as e:
+                assert e.entry == "usr/random/place"
+    finally:
+        dpu.tarball.lzma = saved
@@ -0,0 +1,86 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module tests the timing history, and sharding and ordering by it.
+"""
+
+import os
+
+from dpu.history import (TimingHistory, shard, select_shard, longest_first,
+                         DEFAULT_DURATION)
+from dpu.utils import tmpdir
+
+
+def test_history():
+    """
+    Make sure durations are remembered, and unknown tests are expected to
+    take the median time.
+    """
+    with tmpdir() as tmp:
+        path = os.path.join(tmp, "state", "durations.json")
+        history = TimingHistory(path)
+        assert history.estimates(["foo"]) == {"foo": DEFAULT_DURATION}
+        for test_id, duration in (("a", 1.0), ("b", 5.0), ("c", 2.0),
+                                  ("d", 10.0)):
+            history.record(test_id, duration)
+        history.save()
+
+        estimates = TimingHistory(path).estimates(["a", "d", "new"])
+        assert estimates == {"a": 1.0, "d": 10.0, "new": 3.5}
+
+
+def test_shard():
+    """
+    Make sure the shards cover every test once, are balanced, and don't
+    depend on the order of the tests.
+    """
+    estimates = dict(("t%d" % (x), float(x % 7 + 1)) for x in range(100))
+    tests = sorted(estimates)
+    shards = [shard(tests, estimates, x, 4) for x in range(4)]
+    assert sorted(sum(shards, [])) == tests
+    loads = [sum(estimates[x] for x in s) for s in shards]
+    assert max(loads) - min(loads) <= max(estimates.values())
+    assert shard(reversed(tests), estimates, 2, 4) == shards[2]
+
+    # One very long test gets a shard of its own
+    estimates["t0"] = 1000.0
+    assert shard(tests, estimates, 0, 4) == ["t0"]
+
+
+def test_longest_first():
+    """
+    Make sure the longest tests come first, with new tests in the middle.
+    """
+    with tmpdir() as tmp:
+        history = TimingHistory(os.path.join(tmp, "durations.json"))
+        for test_id, duration in (("a", 1.0), ("b", 5.0), ("c", 3.0)):
+            history.record(test_id, duration)
+        tests = ["a", "b", "c", "new", "another"]
+        assert longest_first(tests, history.estimates(tests)) == \
+            ["b", "another", "c", "new", "a"]
+
+
+def test_select_shard():
+    """
+    Make sure nodes that ran different tests before (and so have different
+    local histories) still split the suite the same way.
+    """
+    tests = ["t%d" % (x) for x in range(20)]
+    with tmpdir() as tmp:
+        node_a = TimingHistory(os.path.join(tmp, "a.json"))
+        node_b = TimingHistory(os.path.join(tmp, "b.json"))
+        for x, test_id in enumerate(tests):
+            node_a.record(test_id, float(x))
+            node_b.record(test_id, float(20 - x))
+        assert shard(tests, node_a.estimates(tests), 0, 3) != \
+            shard(tests, node_b.estimates(tests), 0, 3)
+
+        shared = os.path.join(tmp, "shared.json")
+        node_a.save()
+        os.rename(os.path.join(tmp, "a.json"), shared)
+        for path in (None, shared):
+            shards = [select_shard(tests, x, 3, path) for x in range(3)]
+            assert sorted(sum(shards, [])) == sorted(tests)
+            assert shards == [select_shard(reversed(tests), x, 3, path)
+                              for x in range(3)]
+        assert [len(select_shard(tests, x, 3)) for x in range(3)] == [7, 7, 6]
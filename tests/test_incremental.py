@@ -0,0 +1,33 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module tests remembering the outcome of tests between runs.
+"""
+
+import os
+
+from dpu.incremental import TestState
+from dpu.utils import tmpdir
+
+
+def test_state():
+    """
+    Make sure only tests that passed with the same fingerprint count as
+    unchanged, also after saving and loading the state.
+    """
+    with tmpdir() as tmp:
+        path = os.path.join(tmp, "state", "incremental.json")
+        state = TestState(path)
+        assert not state.unchanged("foo", "abc")
+        state.record("foo", "abc", "passed")
+        state.record("bar", "abc", "failed")
+        state.save()
+
+        state = TestState(path)
+        assert state.unchanged("foo", "abc")
+        assert not state.unchanged("foo", "def")
+        assert not state.unchanged("bar", "abc")
+
+        with open(path, "w") as fd:
+            fd.write("{broken")
+        assert not TestState(path).unchanged("foo", "abc")
@@ -4,7 +4,7 @@
 import os
 import tarfile
 
-from dpu.manifest import parse_manifest
+from dpu.manifest import parse_manifest, check_manifests, artifact_hashes
 from dpu.utils import tmpdir, rsync, mkdir, rm
 from dpu.tarball import open_compressed_tarball
 
@@ -14,7 +14,9 @@ from dpu.exceptions import (ManifestCheckError,
                            EntryNotPresentAssertionError,
                            EntryWrongTypeAssertionError,
                            SymlinkTargetAssertionError,
-                           EntryPermissionAssertionError)
+                           EntryPermissionAssertionError,
+                           ContentMismatchAssertionError,
+                           HardlinkAssertionError)
 
 
 resources = "./tests/resources/"
@@ -167,3 +169,255 @@ def test_implicit_dir():
     except InvalidManifestError as e:
         assert str(e) == \
             "Invalid Manifest: usr cannot be a file and a dir at the same time"
+
+
+def test_check_manifests():
+    manifests = {
+        "good": "contains-file usr/share/doc/foo/copyright\n"
+                "not-present usr/random/place\n",
+        "missing": "contains-file usr/share/doc/foo/missing\n",
+        "unexpected": "not-present usr/bin/script\n",
+    }
+    names = sorted(manifests)
+    tarroot = os.path.join(resources, "manifest-tarball", "root")
+    with tmpdir() as staging:
+        mans = []
+        for name in names:
+            mfile = os.path.join(staging, name)
+            with open(mfile, "w") as fd:
+                fd.write(manifests[name])
+            mans.append(parse_manifest(mfile))
+        tname = os.path.join(staging, "test.tar.gz")
+        tf = tarfile.open(tname, mode="w:gz")
+        tf.add(tarroot, arcname=".", filter=_tar_filter)
+        tf.close()
+        with open_compressed_tarball(tname) as tar:
+            results = dict(zip(names, check_manifests(mans, tar)))
+    assert results["good"] is None
+    assert isinstance(results["missing"], EntryPresentAssertionError)
+    assert results["missing"].entry == "usr/share/doc/foo/missing"
+    assert isinstance(results["unexpected"], EntryNotPresentAssertionError)
+    assert results["unexpected"].entry == "usr/bin/script"
+
+
+def _members(names, seen):
+    for name in names:
+        tinfo = tarfile.TarInfo(name)
+        if name.endswith("script"):
+            tinfo.mode = 0755
+        else:
+            tinfo.type = tarfile.DIRTYPE
+        seen.append(name)
+        yield tinfo
+
+
+def test_early_exit():
+    names = ["./usr", "./usr/bin", "./usr/bin/script"]
+    names.extend("./usr/share/f%d" % x for x in range(1000))
+    with tmpdir() as staging:
+        mfile = os.path.join(staging, "manifest")
+        with open(mfile, "w") as fd:
+            fd.write("contains-entry -rwxr-xr-x usr/bin/script\n")
+        man = parse_manifest(mfile)
+        seen = []
+        man.check_tarball(_members(names, seen))
+        assert len(seen) == 3
+
+        # With a not-present rule, everything has to be looked at
+        with open(mfile, "a") as fd:
+            fd.write("not-present usr/random/place\n")
+        man = parse_manifest(mfile)
+        seen = []
+        man.check_tarball(_members(names, seen))
+        assert len(seen) == len(names)
+
+
+def _tarinfo(name, ttype=tarfile.REGTYPE, mode=0644):
+    tinfo = tarfile.TarInfo(name)
+    tinfo.type = ttype
+    tinfo.mode = mode
+    return tinfo
+
+
+def _check_lines(lines, members):
+    with tmpdir() as staging:
+        mfile = os.path.join(staging, "manifest")
+        with open(mfile, "w") as fd:
+            fd.write("\n".join(lines) + "\n")
+        man = parse_manifest(mfile)
+    man.check_tarball(members)
+
+
+def test_patterns():
+    members = [
+        _tarinfo("./usr", tarfile.DIRTYPE, 0755),
+        _tarinfo("./usr/lib", tarfile.DIRTYPE, 0755),
+        _tarinfo("./usr/lib/x86/libfoo.so.1"),
+        _tarinfo("./usr/lib/x86/libfoo.so", tarfile.SYMTYPE, 0777),
+        _tarinfo("./usr/bin/foo", mode=0755),
+        _tarinfo("./usr/share/doc/foo/changelog.gz"),
+    ]
+    _check_lines(["perm 0644 usr/lib/**.so.*",
+                  "contains-file re:usr/bin/[a-z]+",
+                  "contains-entry -rwxr-xr-x usr/bin/f?o",
+                  "not-present usr/share/doc/*.gz"], members)
+
+    try:
+        _check_lines(["not-present usr/share/doc/*/*.gz"], members)
+        raise AssertionError("not-present pattern did not match")
+    except EntryNotPresentAssertionError as e:
+        assert e.entry == "usr/share/doc/foo/changelog.gz"
+
+    try:
+        _check_lines(["perm 0755 usr/lib/**.so.*"], members)
+        raise AssertionError("perm pattern did not match")
+    except EntryPermissionAssertionError as e:
+        assert e.entry == "usr/lib/x86/libfoo.so.1"
+
+    try:
+        _check_lines(["contains-file re:usr/sbin/.*"], members)
+        raise AssertionError("contains-file pattern matched")
+    except EntryPresentAssertionError as e:
+        assert e.entry == "re:usr/sbin/.*"
+
+    try:
+        _check_lines(["contains-dir usr/bin/*"], members)
+        raise AssertionError("contains-dir pattern matched a file")
+    except EntryWrongTypeAssertionError as e:
+        assert e.entry == "usr/bin/foo"
+
+
+def test_many_patterns():
+    members = [_tarinfo("usr/x%d/re(%d)" % (x, x)) for x in range(150)]
+    lines = ["not-present re:usr/y%d/(a|b)" % x for x in range(150)]
+    _check_lines(lines, members)
+    lines.append("not-present usr/x14?/*")
+    try:
+        _check_lines(lines, members)
+        raise AssertionError("not-present pattern did not match")
+    except EntryNotPresentAssertionError as e:
+        assert e.entry == "usr/x140/re(140)"
+
+
+def test_pattern_groups():
+    members = [
+        _tarinfo("usr/lib/aa/aa.so"),
+        _tarinfo("usr/lib/ab/cd.so"),
+        _tarinfo("usr/share/FOO"),
+    ]
+    # The backreference must keep referring to the group of its own
+    # pattern, not to that of the pattern before it.
+    lines = ["not-present re:usr/(bin|sbin)/.*",
+             "not-present re:usr/lib/(\\w+)/\\1\\.so"]
+    try:
+        _check_lines(lines, members)
+        raise AssertionError("backreference pattern did not match")
+    except EntryNotPresentAssertionError as e:
+        assert e.entry == "usr/lib/aa/aa.so"
+
+    # The same group name in two patterns, and flags that only apply to
+    # one of them
+    _check_lines(["not-present re:usr/(?P<dir>bin)/.*",
+                  "not-present re:usr/(?P<dir>sbin)/.*",
+                  "not-present usr/share/foo",
+                  "contains-file re:(?i)usr/share/foo"], members)
+    try:
+        _check_lines(["not-present re:usr/(?P<dir>bin)/.*",
+                      "not-present re:usr/(?P<dir>lib)/(?P=dir)/.*",
+                      "not-present re:usr/lib/ab/(?P<dir>cd)\\.so"],
+                     members)
+        raise AssertionError("named group pattern did not match")
+    except EntryNotPresentAssertionError as e:
+        assert e.entry == "usr/lib/ab/cd.so"
+
+
+def test_invalid_pattern():
+    try:
+        _check_lines(["not-present re:usr/(lib"], [])
+        raise AssertionError("invalid regex accepted")
+    except InvalidManifestError as e:
+        assert "re:usr/(lib" in str(e)
+
+
+def test_invalid_same_content_keyword():
+    try:
+        _check_lines(["contains-file usr/share/doc/foo/copyright",
+                      "same-content TEST:copyright"], [])
+        raise AssertionError("unknown keyword accepted")
+    except InvalidManifestError as e:
+        assert "TEST" in str(e)
+
+
+def _content_tarball(staging):
+    root = os.path.join(staging, "root")
+    for dpath in ("usr/share/doc/foo", "usr/share/doc/bar", "usr/bin"):
+        mkdir(os.path.join(root, dpath))
+    for fpath in ("usr/share/doc/foo/copyright", "usr/bin/a", "usr/bin/b"):
+        with open(os.path.join(root, fpath), "w") as fd:
+            fd.write("Copyright: DPU AUTHORS\n")
+    os.link(os.path.join(root, "usr/share/doc/foo/copyright"),
+            os.path.join(root, "usr/share/doc/bar/copyright"))
+    with open(os.path.join(staging, "expected"), "w") as fd:
+        fd.write("Copyright: DPU AUTHORS\n")
+    with open(os.path.join(staging, "other"), "w") as fd:
+        fd.write("Copyright: someone else\n")
+    tname = os.path.join(staging, "test.tar.gz")
+    tf = tarfile.open(tname, mode="w:gz")
+    tf.add(root, arcname=".", filter=_tar_filter)
+    tf.close()
+    return tname
+
+
+def _check_content(staging, tname, lines, known_hashes=None):
+    mfile = os.path.join(staging, "manifest")
+    with open(mfile, "w") as fd:
+        fd.write("\n".join(lines) + "\n")
+    man = parse_manifest(mfile)
+    with open_compressed_tarball(tname) as tar:
+        man.check_tarball(tar, known_hashes=known_hashes)
+
+
+def test_same_content_and_hardlinks():
+    with tmpdir() as staging:
+        tname = _content_tarball(staging)
+        hashes = {}
+        _check_content(staging, tname, [
+            "contains-file usr/share/doc/bar/copyright",
+            "same-content TESTDIR:expected",
+            "same-content TESTDIR:expected usr/bin/a",
+            "hardlinks usr/share/doc/foo/copyright "
+            "usr/share/doc/bar/copyright",
+        ], known_hashes=hashes)
+        assert "usr/bin/b" in hashes
+
+        try:
+            _check_content(staging, tname, [
+                "same-content TESTDIR:other usr/share/doc/bar/copyright"])
+            raise AssertionError("Content mismatch not noticed")
+        except ContentMismatchAssertionError as e:
+            assert e.entry == "usr/share/doc/bar/copyright"
+            assert e.expected == "other"
+
+        try:
+            _check_content(staging, tname, ["hardlinks usr/bin/a usr/bin/b"])
+            raise AssertionError("Separate files taken as hardlinks")
+        except HardlinkAssertionError as e:
+            assert e.entry == "usr/bin/b"
+            assert e.expected == "usr/bin/a"
+
+
+def test_artifact_hashes():
+    with tmpdir() as staging:
+        path = os.path.join(staging, "foo.deb")
+        with open(path, "w") as fd:
+            fd.write("foo")
+        hashes = artifact_hashes(path)
+        hashes["usr/bin/a"] = "x"
+        assert artifact_hashes(path) is hashes
+        # The control and data tarballs of a .deb are kept apart
+        assert artifact_hashes(path, "control") == {}
+        assert artifact_hashes(path, "control") is not \
+            artifact_hashes(path, "data")
+        with open(path, "w") as fd:
+            fd.write("foo, changed")
+        assert artifact_hashes(path) == {}
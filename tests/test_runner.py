@@ -0,0 +1,37 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module tests the test scheduler.
+"""
+
+from dpu.runner import TestRunner
+from dpu.utils import abspath
+
+workspace = abspath("./tests/resources/workspace")
+
+
+def test_serial_run():
+    """
+    Make sure a single job runs the tests and reports their outcome.
+    """
+    runner = TestRunner(workspace, jobs=1)
+    results = list(runner.run(["todo-test"]))
+    assert len(results) == 1
+    assert results[0].test_id == "todo-test"
+    assert results[0].status == "skipped"
+    assert sum(s.tests for s in runner.worker_stats.values()) == 1
+
+
+def test_pool_run():
+    """
+    Make sure the pool hands back every result, and errors are reported
+    rather than raised.
+    """
+    runner = TestRunner(workspace, jobs=2)
+    tests = ["todo-test", "invalid-template-call"]
+    results = dict((r.test_id, r) for r in runner.run(tests))
+    assert sorted(results) == sorted(tests)
+    assert results["todo-test"].status == "skipped"
+    assert results["invalid-template-call"].status == "error"
+    assert "InvalidTemplate" in results["invalid-template-call"].error
+    assert sum(s.tests for s in runner.worker_stats.values()) == 2
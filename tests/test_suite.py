@@ -4,8 +4,9 @@
 This module tests the workspace system
 """
 
-from dpu.suite import TestSuite
-from dpu.utils import abspath, tmpdir, mkdir
+from dpu.suite import TestSuite, LayeredContext
+from dpu.utils import abspath, tmpdir, mkdir, rsync
+import dpu.index
 from dpu.exceptions import InvalidTemplate
 import os
 
@@ -23,6 +24,90 @@ def test_test_finder():
     assert tests == []
 
 
+def test_suite_index():
+    """
+    Make sure the index lists the tests and their context, and notices
+    changes to either.
+    """
+    with tmpdir() as tmp:
+        ws_path = os.path.join(tmp, "workspace")
+        rsync(workspace, ws_path)
+        index = os.path.join(tmp, "index.json")
+        ws = TestSuite(ws_path, index=index)
+        ids = ws.test_ids()
+        assert ids == sorted(os.listdir(os.path.join(ws_path, "tests")))
+        assert os.path.exists(index)
+
+        # Everything comes out of the index now
+        load_config = dpu.index.load_config
+        dpu.index.load_config = None
+        try:
+            ws = TestSuite(ws_path, index=index)
+            assert ws.test_ids() == ids
+            assert ws.get_test("nested-thing").name
+        finally:
+            dpu.index.load_config = load_config
+
+        test_json = os.path.join(ws_path, "tests", "nested-thing",
+                                 "test.json")
+        context = open(test_json).read()
+        with open(test_json, "w") as fd:
+            fd.write(context.replace('"testname": "',
+                                     '"testname": "renamed '))
+        os.utime(test_json, (1, 1))
+        mkdir(os.path.join(ws_path, "tests", "aaa-new"))
+        ws = TestSuite(ws_path, index=index)
+        assert ws.test_ids() == ["aaa-new"] + ids
+        assert ws.get_test("nested-thing").name.startswith("renamed ")
+
+
+def test_layered_context():
+    """
+    Make sure earlier layers win, and the layers aren't copied.
+    """
+    test = {"testname": "foo", "source": "foo"}
+    suite = {"source": "bar", "version": {"upstream": "1.0"}}
+    ctx = LayeredContext(test).below(suite)
+    assert ctx["source"] == "foo"
+    assert ctx["version"] is suite["version"]
+    assert sorted(ctx) == ["source", "testname", "version"]
+    assert "version" in ctx and "todo" not in ctx
+    assert dict(ctx.below({"todo": True}))["todo"] is True
+    assert "todo" not in ctx
+
+
+def test_context_precedence():
+    """
+    Make sure the test context wins over the suite's, which wins over the
+    contexts of the templates (later ones over earlier ones).
+    """
+    ws = TestSuite(workspace)
+    ws._template_contexts.update({
+        "first": {"a": "first", "b": "first", "c": "first", "d": "first"},
+        "second": {"a": "second", "b": "second", "c": "second"},
+    })
+    ws._context = {"suite-name": "x", "a": "suite", "b": "suite"}
+    test = ws.get_test("nested-thing")
+    test._context = LayeredContext({"a": "test", "todo": True,
+                                    "testname": "x",
+                                    "templates": ["first", "second"]})
+    test.set_global_context(ws._context)
+    test.run()
+    ctx = test._context
+    assert [ctx[x] for x in "abcd"] == ["test", "suite", "second", "first"]
+
+
+def test_look_up_memo():
+    """
+    Make sure things are only looked up once.
+    """
+    ws = TestSuite(workspace)
+    path = ws._look_up("builders", "source")
+    ws._look_ups[("builders", "source")] = "/somewhere/else"
+    assert ws._look_up("builders", "source") == "/somewhere/else"
+    assert path != "/somewhere/else"
+
+
 def test_crazy_things():
     """
     Make sure we can resolve test folders correctly.
@@ -102,6 +187,32 @@ def test_render_nested():
         assert os.path.exists("%s/kruft" % (path))
 
 
+def test_render_snapshot():
+    """
+    Make sure rendering through snapshots gives the same tree, and the
+    snapshot itself is left alone.
+    """
+    with tmpdir() as snapdir:
+        ws = TestSuite(workspace, snapshot_dir=snapdir,
+                       snapshot_mode="hardlink")
+        for _ in range(2):
+            test = ws.get_test("nested-thing")
+            tm = test.get_template_stack()
+            with tmpdir() as tmp:
+                path = "%s/pkgfoo-1.0" % (tmp)
+                tm.render(path)
+                assert os.path.exists("%s/kruft" % (path))
+                assert os.path.exists("%s/debian/rules" % (path))
+                with open("%s/debian/control" % (path)) as fd:
+                    assert "pkgfoo" in fd.read()
+                # Replacing a cloned file must not touch the snapshot
+                tm.render(path)
+        snapshots = os.listdir(snapdir)
+        assert len(snapshots) == 1
+        assert not os.path.exists(
+            os.path.join(snapdir, snapshots[0], "debian", "control"))
+
+
 def test_upstream_shim():
     ws = TestSuite(workspace)
     test = ws.get_test("native-calls-upstream-shim")
@@ -126,6 +237,26 @@ def test_invalid_template():
     assert True is False
 
 
+def test_checker_version():
+    """
+    Make sure checkers without a version script have an empty version.
+    """
+    ws = TestSuite(workspace)
+    assert ws.checker_version("no-such-checker") == ""
+
+
+def test_workspace_root():
+    """
+    Make sure tests go to the workspace root, unless it is out of space.
+    """
+    with tmpdir() as tmp:
+        ws = TestSuite(workspace, workspace_root=tmp)
+        assert ws.workspace_root() == tmp
+        ws = TestSuite(workspace, workspace_root=tmp,
+                       workspace_min_free=1 << 62)
+        assert ws.workspace_root() is None
+
+
 def test_run_tests():
     """
     Test all the thingers.
@@ -157,3 +288,49 @@ def test_templater():
         mkdir(path)
         tm.render(path)
         # verify path...
+
+
+def test_fingerprint():
+    """
+    Make sure the fingerprint of a test changes along with its inputs, and
+    only then.
+    """
+    with tmpdir() as tmp:
+        ws_path = os.path.join(tmp, "workspace")
+        rsync(workspace, ws_path)
+        for thing in ("templates", "builders", "checkers"):
+            # Relative symlinks; copy what they point at
+            os.unlink(os.path.join(ws_path, thing))
+            rsync(os.path.realpath(os.path.join(workspace, thing)),
+                  os.path.join(ws_path, thing))
+        version = os.path.join(ws_path, "checkers", "lintian-pedantic.version")
+        with open(version, "w") as fd:
+            fd.write("#!/bin/sh\necho 2.5.10\n")
+
+        def fingerprint():
+            return TestSuite(ws_path).get_test("nested-thing").fingerprint()
+
+        orig = fingerprint()
+        assert fingerprint() == orig
+
+        for fpath in ("tests/nested-thing/world/kruft",
+                      "templates/generic/debian/rules",
+                      "builders/source",
+                      "checkers/lintian-pedantic",
+                      "checkers/lintian-pedantic.version",
+                      "context.json"):
+            fpath = os.path.join(ws_path, fpath)
+            content = open(fpath).read()
+            with open(fpath, "w") as fd:
+                fd.write(content.replace('"bar"', '"baz"').replace(
+                    "2.5.10", "2.5.11") + "\n")
+            assert fingerprint() != orig, fpath
+            with open(fpath, "w") as fd:
+                fd.write(content)
+            assert fingerprint() == orig
+
+        # A hook is part of the test directory
+        hook = os.path.join(ws_path, "tests", "nested-thing", "init")
+        with open(hook, "w") as fd:
+            fd.write("#!/bin/sh\n")
+        assert fingerprint() != orig
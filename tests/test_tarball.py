@@ -2,11 +2,15 @@
 # license.
 
 from dpu.tarball import (open_compressed_tarball, make_orig_tarball,
-                         _determine_compression)
+                         _determine_compression, _DecompressorFile)
+import dpu.tarball
 
 from .tarball_helper import make_and_check_tarball
-from dpu.utils import tmpdir, cd, mkdir
+from dpu.utils import tmpdir, cd, mkdir, which
 from functools import partial
+from nose.plugins.skip import SkipTest
+from StringIO import StringIO
+import tarfile
 import os.path
 import os
 
@@ -94,7 +98,8 @@ def test_compression_guesser():
         "foo.tar.gz": "gzip",
         "foo.tar.bz2": "bzip2",
         "foo.tar.xz": "xz",
-        "foo.tar.lzma": "lzma"
+        "foo.tar.lzma": "lzma",
+        "foo.tar.zst": "zstd"
     }
     for thing in things:
         assert things[thing] == _determine_compression(thing)
@@ -154,3 +159,180 @@ def test_xz_pipe_guess():
 
 def test_lzma_pipe_guess():
     mctar("lzma", visit_tarball_path, visit_open=False)
+
+
+def need_zstd():
+    if dpu.tarball.zstandard is None and not which("zstd"):
+        raise SkipTest("zstd not available")
+
+
+def test_zstd():
+    need_zstd()
+    mctar("zstd", visit_open_tarball)
+
+
+def test_zstd_pipe_guess():
+    need_zstd()
+    mctar("zstd", visit_tarball_path, visit_open=False)
+
+
+def test_levels_and_threads():
+    for compression in ("gzip", "bzip2", "xz"):
+        mctar(compression, visit_open_tarball, level=1)
+        mctar(compression, visit_open_tarball, level=1, threads=0)
+
+
+def test_zstd_threads():
+    """
+    Make sure in-process zstd compression uses the threads asked for; 0
+    means one per core, and None or 1 no worker threads.
+    """
+    zstandard = dpu.tarball.zstandard
+    if zstandard is None:
+        raise SkipTest("zstandard module not available")
+    seen = []
+
+    class Module(object):
+        ZstdError = zstandard.ZstdError
+        ZstdDecompressor = zstandard.ZstdDecompressor
+
+        @staticmethod
+        def ZstdCompressor(**kwargs):
+            seen.append(kwargs["threads"])
+            return zstandard.ZstdCompressor(**kwargs)
+
+    saved = (dpu.tarball.zstandard, dpu.tarball.which)
+    dpu.tarball.zstandard = Module
+    dpu.tarball.which = lambda x: None
+    try:
+        for threads in (None, 1, 0, 2):
+            mctar("zstd", visit_open_tarball, threads=threads)
+    finally:
+        dpu.tarball.zstandard, dpu.tarball.which = saved
+    assert seen == [0, 0, -1, 2]
+
+
+def test_external_compressors():
+    """
+    Make sure the command line tools are used without the Python modules.
+    """
+    saved = (dpu.tarball.lzma, dpu.tarball.zstandard)
+    dpu.tarball.lzma = None
+    dpu.tarball.zstandard = None
+    try:
+        for compression in ("xz", "lzma", "zstd"):
+            if not which(compression):
+                continue
+            mctar(compression, visit_open_tarball, level=2)
+            mctar(compression, make_visitor(compression), visit_open=False)
+    finally:
+        dpu.tarball.lzma, dpu.tarball.zstandard = saved
+
+
+def test_reproducible_tarball():
+    pkgname = "pkgfoo"
+    version = "2.0"
+    debdir = "%s-%s" % (pkgname, version)
+
+    for compression in ("gzip", "bzip2", "xz", "zstd"):
+        if compression == "zstd" and dpu.tarball.zstandard is None and \
+                not which("zstd"):
+            continue
+        with tmpdir() as tmp:
+            with cd(tmp):
+                mkdir(os.path.join(debdir, "sub"))
+                for name in ("b", "a", "sub/c"):
+                    with open(os.path.join(debdir, name), "w") as fd:
+                        fd.write(name)
+                tarballs = []
+                for mtime in (1000, 2000):
+                    os.utime(os.path.join(debdir, "a"), (mtime, mtime))
+                    tarball = make_orig_tarball(".", pkgname, version,
+                                                compression=compression,
+                                                mtime=1345321346)
+                    with open(tarball, "rb") as fd:
+                        tarballs.append(fd.read())
+                assert tarballs[0] == tarballs[1]
+                with open_compressed_tarball(tarball) as tar:
+                    names = [x.name for x in tar]
+                assert names == [debdir, debdir + "/a", debdir + "/b",
+                                 debdir + "/sub", debdir + "/sub/c"]
+
+
+def test_truncated_tarball():
+    """
+    Make sure a truncated tarball is an error rather than a shorter one,
+    for every compression.
+    """
+    compressions = ["gzip", "bzip2", "xz", "lzma"]
+    if dpu.tarball.zstandard is not None or which("zstd"):
+        compressions.append("zstd")
+    for compression in compressions:
+        with tmpdir() as tmp:
+            debdir = os.path.join(tmp, "pkgfoo-2.0")
+            mkdir(debdir)
+            for x in range(20):
+                with open(os.path.join(debdir, "f%d" % x), "wb") as fd:
+                    fd.write(os.urandom(4096))
+            tarball = make_orig_tarball(tmp, "pkgfoo", "2.0",
+                                        compression=compression,
+                                        outputdir=tmp)
+            with open(tarball, "rb") as fd:
+                data = fd.read()
+            with open(tarball, "wb") as fd:
+                fd.write(data[:len(data) * 3 // 5])
+            try:
+                with open_compressed_tarball(tarball) as tar:
+                    for tinfo in tar:
+                        pass
+                raise AssertionError("%s: truncation not noticed"
+                                     % (compression))
+            except (IOError, EOFError, tarfile.TarError):
+                pass
+
+
+def test_pipeline_early_close():
+    """
+    Make sure we can stop reading a tarball decompressed by an external
+    process before its end.
+    """
+    if not which("xz"):
+        raise SkipTest("xz not available")
+    saved = dpu.tarball.lzma
+    dpu.tarball.lzma = None
+    try:
+        with tmpdir() as tmp:
+            debdir = os.path.join(tmp, "pkgfoo-2.0")
+            mkdir(debdir)
+            for x in range(50):
+                with open(os.path.join(debdir, "f%d" % x), "wb") as fd:
+                    fd.write(os.urandom(65536))
+            tarball = make_orig_tarball(tmp, "pkgfoo", "2.0",
+                                        compression="xz", outputdir=tmp)
+            with open_compressed_tarball(tarball) as tar:
+                for tinfo in tar:
+                    break
+    finally:
+        dpu.tarball.lzma = saved
+
+
+def test_decompressor_read_size():
+    """
+    Make sure the in-process decompression never hands out more than asked
+    for, even when a chunk decompresses to a lot more, and handles
+    concatenated streams.
+    """
+    lzma = dpu.tarball.lzma
+    if lzma is None:
+        raise SkipTest("lzma module not available")
+    data = "x" * (1 << 20)
+    stream = StringIO(lzma.compress(data) + lzma.compress("tail"))
+    reader = _DecompressorFile(stream, lzma.LZMADecompressor)
+    chunks = []
+    while True:
+        chunk = reader.read(512)
+        if not chunk:
+            break
+        assert len(chunk) <= 512
+        chunks.append(chunk)
+    assert "".join(chunks) == data + "tail"
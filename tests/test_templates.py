@@ -6,9 +6,10 @@ This module contains tests for the template system.
 
 from dpu.templates import (PlainTemplate, JinjaTemplate,
                            DebianShim, UpstreamShim,
-                           TemplateManager)
+                           TemplateManager, set_bytecode_cache)
 
-from dpu.utils import tmpdir, cd, mkdir, abspath
+from dpu.cache import ArtifactCache
+from dpu.utils import tmpdir, cd, mkdir, abspath, rsync
 import os.path
 import os
 
@@ -132,6 +133,32 @@ def test_jinja_template_advanced():
                 assert_content(f, files[f])
 
 
+def test_jinja_bytecode_cache():
+    """
+    Ensure compiled templates end up in the bytecode cache, and rendering
+    from it still works.
+    """
+    context = {
+        "foo": "foo1",
+        "kruft": "kruft1",
+        "plop": "plop1"
+    }
+    with tmpdir() as cache:
+        set_bytecode_cache(cache)
+        try:
+            # A template directory this process has not compiled before
+            where = os.path.join(cache, "jinja1")
+            rsync("tests/resources/templates/jinja1", where)
+            jt1 = JinjaTemplate(where, context=context)
+            for _ in range(2):
+                with tmpdir() as tmp:
+                    jt1.render(tmp)
+                    assert_content(os.path.join(tmp, "foo"), "foo1")
+            assert [x for x in os.listdir(cache) if x != "jinja1"] != []
+        finally:
+            set_bytecode_cache(None)
+
+
 def test_debian_shim_blank():
     """
     Ensure the DebianShim won't error when the directory doesn't have a
@@ -193,6 +220,32 @@ def test_upstream_shim():
         assert "%s/%s-%s" % (tmp, pkgname, version)
 
 
+def test_upstream_shim_cache():
+    """
+    Ensure a cached orig tarball is restored instead of made again.
+    """
+    pkgname = "testpkg-name"
+    version = "1.0"
+    with tmpdir() as tmp:
+        cache = ArtifactCache(os.path.join(tmp, "cache"))
+        tarballs = []
+        for x in range(2):
+            rundir = os.path.join(tmp, str(x))
+            srcdir = os.path.join(rundir, "%s-%s" % (pkgname, version))
+            mkdir(srcdir)
+            with open(os.path.join(srcdir, "foo"), "w") as fd:
+                fd.write("foo")
+            uss = UpstreamShim(pkgname, version, mtime=1345321346,
+                               cache=cache)
+            uss.render(srcdir)
+            tarball = os.path.join(rundir, "%s_%s.orig.tar.gz" % (pkgname,
+                                                                  version))
+            tarballs.append(tarball)
+        assert os.stat(tarballs[0]).st_ino != os.stat(tarballs[1]).st_ino
+        assert open(tarballs[0]).read() == open(tarballs[1]).read()
+        assert cache.size() == os.path.getsize(tarballs[0])
+
+
 def test_template_voodoo():
     """
     Make sure the getattr hack still works right.
@@ -248,6 +301,66 @@ def test_template_manager():
         tplm.render(tmp)
 
 
+def test_template_manager_overlay():
+    """
+    Make sure later templates shadow earlier ones, including when a file
+    takes the place of a directory, and that barriers see the tree as it
+    is at their point in the stack.
+    """
+    with tmpdir() as tmp:
+        layer = os.path.join(tmp, "layer")
+        mkdir(os.path.join(layer, "debian"))
+        with open(os.path.join(layer, "kruft"), "w") as fd:
+            fd.write("not a dir")
+        with open(os.path.join(layer, "debian", "rules"), "w") as fd:
+            fd.write("rules")
+
+        dest = os.path.join(tmp, "dest")
+        tplm = TemplateManager()
+        tplm.add_template("PlainTemplate", "tests/resources/templates/plain1")
+        tplm.add_template("PlainTemplate", "tests/resources/templates/plain2")
+        tplm.add_template("PlainTemplate", layer)
+        tplm.add_template("DebianShim")
+        tplm.add_template("PlainTemplate", "tests/resources/templates/plain1")
+        tplm.render(dest)
+
+        with cd(dest):
+            assert_content("foo", "foo")
+            assert_content("bar", "bar")
+            assert_content("kruft", "not a dir")
+            assert not os.path.exists("debian")
+
+
+def test_template_manager_dir_over_symlink():
+    """
+    Make sure a directory replaces a symlink written before a barrier,
+    rather than being written through it.
+    """
+    with tmpdir() as tmp:
+        outside = os.path.join(tmp, "outside")
+        mkdir(outside)
+        first = os.path.join(tmp, "first")
+        mkdir(first)
+        os.symlink(outside, os.path.join(first, "docs"))
+        second = os.path.join(tmp, "second")
+        mkdir(os.path.join(second, "docs"))
+        with open(os.path.join(second, "docs", "README"), "w") as fd:
+            fd.write("readme")
+
+        dest = os.path.join(tmp, "dest")
+        tplm = TemplateManager()
+        tplm.add_template("PlainTemplate", first)
+        tplm.add_template("DebianShim")
+        tplm.add_template("PlainTemplate", second)
+        tplm.render(dest)
+
+        with cd(dest):
+            assert not os.path.islink("docs")
+            assert os.path.isdir("docs")
+            assert_content("docs/README", "readme")
+        assert os.listdir(outside) == []
+
+
 def test_real_template_thing():
     """
     Make sure None templates throw errors
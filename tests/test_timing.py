@@ -0,0 +1,66 @@
+# Copyright (c) DPU AUTHORS, under the terms and conditions of the GPL-2+
+# license.
+"""
+This module tests timing the stages of tests.
+"""
+
+import sys
+import json
+import subprocess
+from StringIO import StringIO
+
+from dpu.runner import TestRunner
+from dpu.timing import (StageTimer, stage_totals, write_json_lines,
+                        chrome_trace)
+from dpu.utils import abspath, run_command, command_output
+
+workspace = abspath("./tests/resources/workspace")
+
+
+def test_stage_timer():
+    """
+    Make sure stages get the peak RSS of the commands run in them, nested
+    ones included, and failing commands still fail.
+    """
+    timer = StageTimer()
+    with timer.stage("outer"):
+        with timer.stage("inner"):
+            run_command([sys.executable, "-c", "x = ' ' * (64 << 20)"])
+        assert command_output(["echo", "hi"]) == "hi\n"
+        try:
+            run_command(["sh", "-c", "exit 3"])
+            raise AssertionError("The command did not fail")
+        except subprocess.CalledProcessError as e:
+            assert e.returncode == 3
+    inner, outer = timer.stages
+    assert inner["stage"] == "inner" and outer["stage"] == "outer"
+    assert inner["maxrss"] >= 64 * 1024
+    # Forked children count the RSS of this process before their exec
+    assert outer["maxrss"] >= inner["maxrss"]
+    assert outer["wall"] >= inner["wall"] > 0
+    assert outer["child_cpu"] >= inner["child_cpu"] > 0
+
+
+def test_export():
+    """
+    Make sure the timings of a run come back to the parent, and can be
+    written out.
+    """
+    runner = TestRunner(workspace, jobs=2)
+    results = list(runner.run(["todo-test", "hook-basics"]))
+    stages = [s["stage"] for s in results[0].timings]
+    assert "context" in stages
+
+    out = StringIO()
+    write_json_lines(out, results)
+    lines = [json.loads(x) for x in out.getvalue().splitlines()]
+    assert len(lines) == sum(len(r.timings) for r in results)
+    assert set(x["test"] for x in lines) == set(["todo-test", "hook-basics"])
+    assert stage_totals(results)["context"]["count"] == 2
+
+    events = chrome_trace(results)["traceEvents"]
+    tests = [x for x in events if x.get("cat") == "test"]
+    assert len(tests) == 2
+    for event in events:
+        if event["ph"] == "X":
+            assert event["dur"] >= 0 and event["tid"] in runner.worker_stats
@@ -5,7 +5,10 @@ This module tests some basics in the utils class.
 """
 
 from dpu.utils import (dir_walk, mkdir, tmpdir, cd,
-                       diff, diff_against_string)
+                       diff, diff_against_string, hash_tree,
+                       changes_files, rsync, copy_file)
+import dpu.utils
+import os
 
 resources = "./tests/resources/"
 
@@ -119,3 +122,131 @@ def test_string_diff_output():
         cp1 = open(f, "r").read()
         cp2 = open("tests/resources/util-diff/diff.str", "r").read()
         assert cp1 == cp2
+
+
+def test_diff_no_newline():
+    """
+    Make sure a missing newline at the end is reported the way diff does.
+    """
+    with tmpdir() as tmp:
+        a = os.path.join(tmp, "a")
+        b = os.path.join(tmp, "b")
+        with open(a, "w") as fd:
+            fd.write("foo\nbar")
+        with open(b, "w") as fd:
+            fd.write("foo\nbar\n")
+        assert diff(a, a)
+        out = os.path.join(tmp, "out")
+        with open(out, "w") as fd:
+            assert not diff(a, b, output_fd=fd)
+        assert open(out).read() == (
+            "--- %s\n+++ %s\n@@ -1,2 +1,2 @@\n foo\n-bar\n"
+            "\\ No newline at end of file\n+bar\n" % (a, b))
+
+
+def test_hash_tree():
+    """
+    Make sure the tree hash follows content and modes, but not timestamps.
+    """
+    with tmpdir() as t:
+        with cd(t):
+            mkdir("foo")
+            with open("foo/bar", "w") as fd:
+                fd.write("bar")
+        first = hash_tree(t)
+        os.utime(os.path.join(t, "foo/bar"), (0, 0))
+        assert hash_tree(t) == first
+        os.chmod(os.path.join(t, "foo/bar"), 0755)
+        assert hash_tree(t) != first
+
+
+def test_changes_files():
+    """
+    Make sure we find the files a .changes refers to.
+    """
+    with tmpdir() as t:
+        fpath = os.path.join(t, "foo.changes")
+        with open(fpath, "w") as fd:
+            fd.write("Source: foo\n"
+                     "Checksums-Sha1:\n"
+                     " 0123 3 foo_1.0.dsc\n"
+                     "Files:\n"
+                     " abcd 3 devel optional foo_1.0.dsc\n"
+                     " abcd 4 devel optional foo_1.0.tar.gz\n"
+                     "Description: foo\n"
+                     " not a file\n")
+        assert changes_files(fpath) == ["foo_1.0.dsc", "foo_1.0.tar.gz"]
+
+
+def test_rsync():
+    """
+    Make sure the tree copy keeps symlinks and modes, honours excludes and
+    replaces what's in the way.
+    """
+    with tmpdir() as t:
+        with cd(t):
+            mkdir("src/sub")
+            mkdir("dest/link")
+            touch("src/sub/skip.tpl")
+            with open("src/script", "w") as fd:
+                fd.write("#!/bin/sh")
+            os.chmod("src/script", 0755)
+            os.symlink("script", "src/link")
+            with open("dest/script", "w") as fd:
+                fd.write("old")
+
+            rsync("src", "dest", excludes=["*.tpl"])
+
+            assert open("dest/script").read() == "#!/bin/sh"
+            assert os.stat("dest/script").st_mode & 0777 == 0755
+            assert os.readlink("dest/link") == "script"
+            assert os.path.isdir("dest/sub")
+            assert not os.path.exists("dest/sub/skip.tpl")
+
+
+def test_copy_file_fast():
+    """
+    Make sure every way the kernel has of copying copies all of a file.
+    """
+    content = "dpu " * 50000
+    saved = dpu.utils._FAST_COPIES
+    assert saved
+    try:
+        for call in saved:
+            with tmpdir() as t:
+                with cd(t):
+                    with open("src", "w") as fd:
+                        fd.write(content)
+                    dpu.utils._FAST_COPIES = [call]
+                    copy_file("src", "dest")
+                    assert open("dest").read() == content
+    finally:
+        dpu.utils._FAST_COPIES = saved
+
+
+def test_copy_file_short():
+    """
+    Make sure a copy the kernel stops short of is finished with read and
+    write.
+    """
+    calls = []
+
+    def short_copy(infd, outfd, count):
+        calls.append(count)
+        if len(calls) > 1:
+            return 0
+        return os.write(outfd, os.read(infd, 10))
+
+    content = "dpu " * 50000
+    saved = dpu.utils._FAST_COPIES
+    dpu.utils._FAST_COPIES = [short_copy]
+    try:
+        with tmpdir() as t:
+            with cd(t):
+                with open("src", "w") as fd:
+                    fd.write(content)
+                copy_file("src", "dest")
+                assert open("dest").read() == content
+    finally:
+        dpu.utils._FAST_COPIES = saved
+    assert calls == [len(content), len(content) - 10]